@@ -0,0 +1,175 @@
+"""Many writers on one member's balance, then a mixed-write stress run.
+
+The benchmark has --writers concurrent writers add to the same member for
+each BALANCE_STRIPES value in --stripes and reports writes per second.
+Each write holds its transaction open for --hold-ms after the upsert,
+standing in for the commit round trip to a remote Postgres during which
+the row lock is held.
+
+The stress run then mixes, concurrently: tap batches for several members
+where some increment and some take the clamping path, settles, pending
+confirmations and back-to-back compaction. It fails on any write error
+(a deadlock included) or if a balance drifts from its ledger.
+
+    python bench_balances.py --database-url postgresql://localhost/swearjar_load
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+from loadtest import load_bot_for_db, scratch_chat_id
+
+
+def drift(c, chat_id):
+    """Members of chat_id whose balance (with deltas) differs from their ledger."""
+    c.execute("""
+        SELECT b.telegram_id, b.amount_cents + COALESCE(d.total, 0), COALESCE(l.total, 0)
+        FROM balances b
+        LEFT JOIN (
+            SELECT telegram_id, SUM(amount_cents)::BIGINT AS total
+            FROM balance_deltas WHERE chat_id = %(chat_id)s GROUP BY telegram_id
+        ) d ON d.telegram_id = b.telegram_id
+        LEFT JOIN (
+            SELECT telegram_id, SUM(amount_cents)::BIGINT AS total
+            FROM ledger WHERE chat_id = %(chat_id)s GROUP BY telegram_id
+        ) l ON l.telegram_id = b.telegram_id
+        WHERE b.chat_id = %(chat_id)s
+          AND b.amount_cents + COALESCE(d.total, 0) <> COALESCE(l.total, 0)
+    """, {"chat_id": chat_id})
+    return c.fetchall()
+
+
+async def benchmark(args, bot):
+    """{stripes: (writes per second, failures)}"""
+    results = {}
+    for stripes in args.stripes:
+        bot.BALANCE_STRIPES = stripes
+        chat_id = scratch_chat_id()
+        hold = args.hold_ms / 1000
+
+        def add_and_hold(c):
+            bot.add_to_balance(c, 1, chat_id, "Member", bot.SWEAR_CENTS)
+            c.execute("SELECT pg_sleep(%s)", (hold,))
+
+        async def writer():
+            for _ in range(args.writes):
+                await bot.run_db(add_and_hold)
+
+        started = time.perf_counter()
+        outcomes = await asyncio.gather(*(writer() for _ in range(args.writers)), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        failures = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        failures += await bot.run_db(drift, chat_id)
+        results[stripes] = (args.writers * args.writes / elapsed, failures)
+    return results
+
+
+async def stress(args, bot):
+    """Returns (writes attempted, errors, drifting members)."""
+    bot.BALANCE_STRIPES = max(args.stripes)
+    chat_id = scratch_chat_id()
+    members = list(range(1, args.members + 1))
+    rng = random.Random(args.seed)
+    swear = bot.SWEAR_CENTS
+    deadline = time.monotonic() + args.seconds
+    attempted = 0
+    errors = []
+
+    def tap_batch():
+        # Per member: a run of ➕ (plain increment) or one that dips
+        # below zero and clamps, which locks the balance row
+        batch = {}
+        for user_id in rng.sample(members, rng.randint(2, len(members))):
+            if rng.random() < 0.5:
+                batch[user_id] = (f"Member{user_id}", swear * rng.randint(1, 3), 0)
+            else:
+                batch[user_id] = (f"Member{user_id}", -swear * rng.randint(1, 3), 0)
+        return batch
+
+    async def write(fn, *fn_args):
+        nonlocal attempted
+        attempted += 1
+        try:
+            await bot.run_db(fn, *fn_args)
+        except Exception as e:
+            errors.append(e)
+
+    async def tapper():
+        while time.monotonic() < deadline:
+            await write(bot.apply_taps, chat_id, tap_batch())
+
+    async def settler():
+        while time.monotonic() < deadline:
+            await write(bot.settle_balance, rng.choice(members), chat_id)
+            await asyncio.sleep(0.01)
+
+    async def proxy():
+        while time.monotonic() < deadline:
+            to_user = rng.choice(members)
+            await write(bot.insert_pending, 0, "Proxy", to_user, chat_id, swear)
+            for transaction_id, _, _ in await bot.run_db(bot.fetch_pending_for_user, to_user, chat_id):
+                await write(bot.confirm_pending, transaction_id, to_user, f"Member{to_user}", chat_id)
+
+    async def compactor():
+        while time.monotonic() < deadline:
+            await write(bot.compact_balance_deltas)
+
+    await asyncio.gather(
+        *(tapper() for _ in range(args.writers // 2)),
+        settler(), proxy(), compactor(), compactor()
+    )
+    return attempted, errors, await bot.run_db(drift, chat_id)
+
+
+async def run(args, bot):
+    await asyncio.to_thread(bot.init_pool)
+    try:
+        await asyncio.get_running_loop().run_in_executor(bot.db_executor, bot.init_db)
+        return await benchmark(args, bot), await stress(args, bot)
+    finally:
+        await asyncio.to_thread(bot.close_pool)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database-url", required=True, help="scratch Postgres the bot may migrate")
+    parser.add_argument("--writers", type=int, default=32, help="concurrent writers (and DB pool size)")
+    parser.add_argument("--writes", type=int, default=50, help="writes per writer in the benchmark")
+    parser.add_argument("--hold-ms", type=float, default=1, help="time each write keeps its row lock")
+    parser.add_argument("--stripes", default="1,8", help="BALANCE_STRIPES values to benchmark")
+    parser.add_argument("--members", type=int, default=4, help="members in the stress run's chat")
+    parser.add_argument("--seconds", type=float, default=10, help="length of the stress run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--min-speedup", type=float,
+                        help="fail unless the most stripes beat 1 stripe by this factor")
+    args = parser.parse_args(argv)
+    args.stripes = [int(stripes) for stripes in args.stripes.split(",")]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bot = load_bot_for_db(args.database_url, args.writers)
+    bench, (attempted, errors, drifted) = asyncio.run(run(args, bot))
+
+    failures = []
+    for stripes, (rate, bench_failures) in bench.items():
+        print(f"{args.writers} writers on one member, {stripes} stripe(s): {rate:.0f} writes/s")
+        failures += [f"benchmark with {stripes} stripe(s): {failure!r}" for failure in bench_failures]
+    if args.min_speedup is not None and 1 in bench:
+        speedup = bench[max(args.stripes)][0] / bench[1][0]
+        if speedup < args.min_speedup:
+            failures.append(f"{max(args.stripes)} stripes only {speedup:.1f}x faster than 1")
+
+    print(f"stress: {attempted} mixed writes with compaction in {args.seconds:.0f}s, "
+          f"{len(errors)} errors, {len(drifted)} balances off their ledger")
+    failures += [f"stress write failed: {error!r}" for error in errors[:5]]
+    failures += [f"member {user_id}: balance {balance} != ledger {ledger}" for user_id, balance, ledger in drifted]
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
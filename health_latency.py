@@ -0,0 +1,98 @@
+"""/health latency while Postgres is busy with slow queries.
+
+Starts the bot in webhook mode (see loadtest.py), ties up every DB worker
+with a deliberately slow query, and probes GET /health throughout. Blocking
+DB work runs on the DB executor, so the probes must stay fast; the run
+exits non-zero if the slowest one exceeds --max-ms.
+
+    python health_latency.py --database-url postgresql://localhost/swearjar_load
+"""
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from aiohttp import ClientSession
+from loadtest import FakeBotApi, load_bot, percentile, wait_until
+
+
+def slow_query(c, seconds):
+    c.execute("SELECT pg_sleep(%s)", (seconds,))
+
+
+async def probe_health(args):
+    fake_api = FakeBotApi(0)
+    await fake_api.start(args.api_port)
+    with tempfile.TemporaryDirectory(prefix="swearjar-health-") as workdir:
+        bot = load_bot(args, workdir)
+        bot_task = asyncio.create_task(bot.run())
+        try:
+            async with ClientSession() as session:
+                url = f"http://127.0.0.1:{args.port}/health"
+
+                async def healthy():
+                    try:
+                        async with session.get(url) as response:
+                            return response.status == 200
+                    except OSError:
+                        return False
+                if not await wait_until(healthy, 30):
+                    raise RuntimeError("bot did not come up; see its log output")
+
+                workers = bot.db_executor._max_workers
+                slow = [
+                    asyncio.create_task(bot.run_db(slow_query, args.query_seconds))
+                    for _ in range(workers)
+                ]
+                # Let every worker pick its query up
+                await asyncio.sleep(0.2)
+                latencies = []
+                while not all(task.done() for task in slow):
+                    started = time.perf_counter()
+                    async with session.get(url) as response:
+                        await response.read()
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    await asyncio.sleep(args.interval_ms / 1000)
+                await asyncio.gather(*slow)
+        finally:
+            bot_task.cancel()
+            try:
+                await bot_task
+            except asyncio.CancelledError:
+                pass
+            await fake_api.stop()
+    return workers, sorted(latencies)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database-url", required=True, help="scratch Postgres the bot may migrate")
+    parser.add_argument("--query-seconds", type=float, default=2, help="how long each slow query runs")
+    parser.add_argument("--interval-ms", type=float, default=10, help="pause between /health probes")
+    parser.add_argument("--max-ms", type=float, default=50, help="slowest acceptable /health response")
+    parser.add_argument("--port", type=int, default=18443)
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    args = parser.parse_args(argv)
+    # load_bot() options this script doesn't expose
+    args.telegram_limits = False
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workers, latencies = asyncio.run(probe_health(args))
+    if not latencies:
+        print("FAIL: no /health probes completed while the slow queries ran", file=sys.stderr)
+        return 1
+    print(f"{len(latencies)} /health probes while {workers} DB workers ran {args.query_seconds}s queries: "
+          f"p50 {percentile(latencies, 50):.2f} ms  p99 {percentile(latencies, 99):.2f} ms  "
+          f"max {latencies[-1]:.2f} ms")
+    if latencies[-1] > args.max_ms:
+        print(f"FAIL: slowest /health {latencies[-1]:.2f} ms > {args.max_ms}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
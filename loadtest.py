@@ -0,0 +1,606 @@
+"""Replay load test for swear_jar_bot.py.
+
+Starts the bot exactly as run() does in webhook mode, pointed at a local
+fake Bot API server, then POSTs a stream of updates to the webhook and
+reports throughput, end-to-end latency, DB calls per update and Bot API
+calls per update.
+
+An update's latency runs from its POST until the bot acks its journal
+entry: when its handlers return or, for a ➕/➖ tap, once its coalesced
+batch is written. Tap latency therefore includes TAP_COALESCE_MS and the
+DB write. "Tap visible" latency runs on to the first editMessageText of
+the tap's message that the fake API receives after that ack, which is
+when the member would see the new total.
+
+    python loadtest.py --database-url postgresql://localhost/swearjar_load \\
+        --chats 20 --users 4 --updates 2000 --rate 200
+
+The database must be a scratch one: the bot migrates it and writes to it,
+and --reset truncates its tables first. Use --replay FILE to send recorded
+updates (one Telegram update JSON object per line) instead of the synthetic
+mix, and --save FILE to keep a synthetic stream for later replays. The
+bot's outbound rate limits are lifted unless --telegram-limits is given. The
+--max-*/--min-* options make the run exit non-zero when a threshold is
+missed, so it can gate performance regressions.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import importlib
+from bisect import bisect_left
+from aiohttp import web, ClientSession, TCPConnector
+
+# ======================
+# FAKE BOT API
+# ======================
+class FakeBotApi:
+    """Answers Bot API calls like Telegram would and records each one."""
+
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+        # (method, params) in arrival order
+        self.calls = []
+        # (chat_id, message_id) -> perf_counter() of each editMessageText
+        self.edited_at = {}
+        self._next_message_id = 1_000_000
+        self._runner = None
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls.append((method, params))
+        if method == "editMessageText":
+            key = (int(params["chat_id"]), int(params["message_id"]))
+            self.edited_at.setdefault(key, []).append(time.perf_counter())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = {
+                "id": 1, "is_bot": True, "first_name": "Swear Jar", "username": "swearjar_load_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False,
+                "supports_inline_queries": False
+            }
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            message_id = params.get("message_id")
+            if message_id is None:
+                self._next_message_id += 1
+                message_id = self._next_message_id
+            result = {
+                "message_id": int(message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                "text": params.get("text", "")
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+# ======================
+# UPDATE STREAMS
+# ======================
+# Every synthetic chat has one pinned scoreboard message the buttons belong to
+SCOREBOARD_MESSAGE_ID = 1
+
+
+def callback_update(chat_id, user_id, data):
+    return {"callback_query": {
+        "id": "",
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "chat_instance": str(chat_id),
+        "data": data,
+        "message": {
+            "message_id": SCOREBOARD_MESSAGE_ID,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group"},
+            "text": "Swear Jar"
+        }
+    }}
+
+
+def text_update(chat_id, user_id, text):
+    message = {
+        "message_id": 0,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "group"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": text
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"message": message}
+
+
+def chat_members(chats, users):
+    """{chat_id: [user_id, ...]} for the synthetic group chats."""
+    return {
+        -1_000_000 - chat: [100_000 + chat * users + n for n in range(users)]
+        for chat in range(chats)
+    }
+
+
+def scenario(rng, chat_id, user_id, others):
+    """One thing a member does, as the updates it produces in order."""
+    roll = rng.random()
+    if roll < 0.55:
+        return [callback_update(chat_id, user_id, "plus")] * rng.randint(1, 4)
+    if roll < 0.65:
+        return [callback_update(chat_id, user_id, "minus")]
+    if roll < 0.72:
+        return [callback_update(chat_id, user_id, "back_to_scoreboard")]
+    if roll < 0.77:
+        answer = rng.choice(["settle_confirm", "settle_cancel"])
+        return [callback_update(chat_id, user_id, "settle"), callback_update(chat_id, user_id, answer)]
+    if roll < 0.85 and others:
+        to_user = rng.choice(others)
+        return (
+            [callback_update(chat_id, user_id, "proxy_start"),
+             callback_update(chat_id, user_id, f"proxy_select_{to_user}")]
+            + [callback_update(chat_id, user_id, "proxy_plus")] * rng.randint(1, 3)
+            + [callback_update(chat_id, user_id, "proxy_confirm")]
+        )
+    if roll < 0.87:
+        return [text_update(chat_id, user_id, "/start")]
+    return [text_update(chat_id, user_id, "lol")]
+
+
+def synthetic_updates(members, count, seed):
+    """Interleave members' scenarios into a stream of `count` updates.
+
+    Each member's own updates stay in order, so multi-step flows (settle,
+    proxy add) arrive the way a real client would send them.
+    """
+    rng = random.Random(seed)
+    queues = {(chat_id, user_id): [] for chat_id, users in members.items() for user_id in users}
+    keys = list(queues)
+    stream = []
+    while len(stream) < count:
+        chat_id, user_id = key = rng.choice(keys)
+        if not queues[key]:
+            others = [other for other in members[chat_id] if other != user_id]
+            queues[key] = scenario(rng, chat_id, user_id, others)
+        stream.append(queues[key].pop(0))
+    return stream
+
+
+def number_updates(updates, first_id):
+    """Give every update a fresh update_id (and callback/message ids to match)."""
+    numbered = []
+    for update_id, update in enumerate(updates, start=first_id):
+        update = json.loads(json.dumps(update))
+        update["update_id"] = update_id
+        if "callback_query" in update:
+            update["callback_query"]["id"] = f"load{update_id}"
+        if "message" in update:
+            update["message"]["message_id"] = update_id
+        numbered.append(update)
+    return numbered
+
+# ======================
+# METRICS
+# ======================
+METRIC_LINE = re.compile(r'^(\w+)(?:\{([^}]*)\})? (\S+)$')
+
+
+def parse_metrics(text):
+    """{(name, labels): value} from the Prometheus text format."""
+    values = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            values[(name, labels or "")] = float(value)
+    return values
+
+
+def metric_total(values, name):
+    return sum(value for (metric, _), value in values.items() if metric == name)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+# ======================
+# LOAD RUN
+# ======================
+async def wait_until(predicate, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await predicate():
+            return True
+        await asyncio.sleep(interval)
+    return False
+
+
+class LoadRun:
+    def __init__(self, args, bot, fake_api):
+        self.args = args
+        self.bot = bot
+        self.fake_api = fake_api
+        self.webhook_url = f"http://127.0.0.1:{args.port}/{bot.BOT_TOKEN}"
+        self.base_url = f"http://127.0.0.1:{args.port}"
+        # update_id -> perf_counter() at POST / when the bot acked it
+        self.sent_at = {}
+        self.processed_at = {}
+        # update_id -> (chat_id, message_id) of ➕/➖ taps
+        self.taps = {}
+        self.response_seconds = []
+        self.statuses = {}
+        self._watch_processing()
+
+    def _watch_processing(self):
+        # Stamp each update as the bot acks its journal entry. run() creates
+        # the journal, so the class is patched.
+        journal = self.bot.UpdateJournal
+        ack = journal.ack
+
+        def timed_ack(journal_self, update_id):
+            ack(journal_self, update_id)
+            self.processed_at[update_id] = time.perf_counter()
+
+        journal.ack = timed_ack
+
+    async def metrics(self, session):
+        async with session.get(f"{self.base_url}/metrics") as response:
+            return parse_metrics(await response.text())
+
+    async def post(self, session, update):
+        started = time.perf_counter()
+        self.sent_at[update["update_id"]] = started
+        query = update.get("callback_query")
+        if query and query.get("data") in ("plus", "minus") and "message" in query:
+            self.taps[update["update_id"]] = (query["message"]["chat"]["id"], query["message"]["message_id"])
+        async with session.post(self.webhook_url, json=update) as response:
+            await response.read()
+            self.statuses[response.status] = self.statuses.get(response.status, 0) + 1
+        self.response_seconds.append(time.perf_counter() - started)
+
+    async def send(self, session, updates, rate):
+        loop = asyncio.get_running_loop()
+        # Telegram keeps at most this many webhook requests open at once
+        slots = asyncio.Semaphore(self.args.connections)
+        start = loop.time()
+        tasks = []
+
+        async def post_one(update):
+            try:
+                await self.post(session, update)
+            finally:
+                slots.release()
+
+        for i, update in enumerate(updates):
+            if rate:
+                delay = start + i / rate - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await slots.acquire()
+            tasks.append(asyncio.create_task(post_one(update)))
+        await asyncio.gather(*tasks)
+
+    async def drain(self, session, timeout):
+        """Wait until the bot has nothing queued, in flight, batched or left to edit."""
+        async def idle():
+            values = await self.metrics(session)
+            return (
+                metric_total(values, "swearjar_update_backlog") == 0
+                and metric_total(values, "swearjar_updates_in_flight") == 0
+                and metric_total(values, "swearjar_tap_batches_pending") == 0
+                and metric_total(values, "swearjar_edits_queued") == 0
+            )
+        drained = await wait_until(idle, timeout)
+        await asyncio.sleep(self.args.settle_seconds)
+        return drained
+
+
+async def run_load(args, bot, fake_api, updates):
+    connector = TCPConnector(limit=args.connections)
+    async with ClientSession(connector=connector) as session:
+        load = LoadRun(args, bot, fake_api)
+
+        async def healthy():
+            try:
+                async with session.get(f"{load.base_url}/health") as response:
+                    return response.status == 200
+            except OSError:
+                return False
+        if not await wait_until(healthy, 30):
+            raise RuntimeError("bot did not come up; see its log output")
+
+        members = chat_members(args.chats, args.users)
+        if not args.replay:
+            # Give every member a balance row so proxy adds have someone to pick
+            warmup = number_updates(
+                [callback_update(chat_id, user_id, "plus") for chat_id, users in members.items() for user_id in users],
+                first_id=1
+            )
+            await load.send(session, warmup, rate=0)
+            await load.drain(session, args.drain_timeout)
+        load.sent_at.clear()
+        load.processed_at.clear()
+        load.taps.clear()
+        load.response_seconds.clear()
+        load.statuses.clear()
+
+        before = await load.metrics(session)
+        calls_before = len(fake_api.calls)
+        started = time.perf_counter()
+        await load.send(session, updates, args.rate)
+        sent_seconds = time.perf_counter() - started
+        drained = await load.drain(session, args.drain_timeout)
+        after = await load.metrics(session)
+
+    return build_report(args, load, fake_api, calls_before, before, after, sent_seconds, drained)
+
+
+def tap_visible_seconds(load, fake_api):
+    """(seconds from POST to the first edit of its message after its ack, per
+    acked tap; taps acked with no edit after them)"""
+    visible = []
+    unseen = 0
+    for update_id, key in load.taps.items():
+        acked = load.processed_at.get(update_id)
+        if acked is None:
+            continue
+        edits = fake_api.edited_at.get(key, [])
+        index = bisect_left(edits, acked)
+        if index == len(edits):
+            # e.g. ➖ at $0, which leaves the scoreboard as it was
+            unseen += 1
+        else:
+            visible.append(edits[index] - load.sent_at[update_id])
+    return visible, unseen
+
+
+def build_report(args, load, fake_api, calls_before, before, after, sent_seconds, drained):
+    def delta(name):
+        return metric_total(after, name) - metric_total(before, name)
+
+    processed = [
+        load.processed_at[update_id] - sent
+        for update_id, sent in load.sent_at.items()
+        if update_id in load.processed_at
+    ]
+    latencies = sorted(seconds * 1000 for seconds in processed)
+    tap_visible, taps_unseen = tap_visible_seconds(load, fake_api)
+    tap_visible = sorted(seconds * 1000 for seconds in tap_visible)
+    api_calls = fake_api.calls[calls_before:]
+    responses = sorted(seconds * 1000 for seconds in load.response_seconds)
+    count = len(processed) or 1
+    if processed:
+        first_sent = min(load.sent_at.values())
+        last_done = max(load.processed_at[update_id] for update_id in load.sent_at if update_id in load.processed_at)
+        throughput = len(processed) / max(last_done - first_sent, 1e-9)
+    else:
+        throughput = 0.0
+
+    methods = {}
+    for method, _ in api_calls:
+        methods[method] = methods.get(method, 0) + 1
+    inline_answers = delta("swearjar_inline_answers_total")
+
+    return {
+        "updates_sent": len(load.sent_at),
+        "updates_processed": len(processed),
+        "http_statuses": {str(status): n for status, n in sorted(load.statuses.items())},
+        "text_shed": delta("swearjar_shed_text_total"),
+        "drained": drained,
+        "send_seconds": round(sent_seconds, 3),
+        "throughput_per_second": round(throughput, 1),
+        "latency_ms": {f"p{pct}": round(percentile(latencies, pct), 2) for pct in (50, 95, 99)},
+        "tap_visible_ms": {f"p{pct}": round(percentile(tap_visible, pct), 2) for pct in (50, 95, 99)},
+        "taps_without_edit": taps_unseen,
+        "webhook_response_ms": {f"p{pct}": round(percentile(responses, pct), 2) for pct in (50, 95, 99)},
+        "db_calls_per_update": round(delta("swearjar_db_seconds_count") / count, 3),
+        "api_calls_per_update": round(len(api_calls) / count, 3),
+        "inline_answers_per_update": round(inline_answers / count, 3),
+        "api_calls_by_method": dict(sorted(methods.items())),
+        "edits_skipped": delta("swearjar_edits_skipped_total"),
+        "edits_superseded": delta("swearjar_api_edits_superseded_total"),
+        "edits_replaced": delta("swearjar_edits_replaced_total"),
+    }
+
+
+def check_gates(args, report):
+    failures = []
+    if args.max_p95_ms is not None and report["latency_ms"]["p95"] > args.max_p95_ms:
+        failures.append(f"p95 latency {report['latency_ms']['p95']} ms > {args.max_p95_ms}")
+    if args.max_p99_ms is not None and report["latency_ms"]["p99"] > args.max_p99_ms:
+        failures.append(f"p99 latency {report['latency_ms']['p99']} ms > {args.max_p99_ms}")
+    if args.max_tap_visible_p95_ms is not None and report["tap_visible_ms"]["p95"] > args.max_tap_visible_p95_ms:
+        failures.append(f"p95 tap visible latency {report['tap_visible_ms']['p95']} ms > {args.max_tap_visible_p95_ms}")
+    if args.min_throughput is not None and report["throughput_per_second"] < args.min_throughput:
+        failures.append(f"throughput {report['throughput_per_second']}/s < {args.min_throughput}")
+    if args.max_db_per_update is not None and report["db_calls_per_update"] > args.max_db_per_update:
+        failures.append(f"DB calls per update {report['db_calls_per_update']} > {args.max_db_per_update}")
+    if args.max_api_per_update is not None and report["api_calls_per_update"] > args.max_api_per_update:
+        failures.append(f"API calls per update {report['api_calls_per_update']} > {args.max_api_per_update}")
+    if not report["drained"]:
+        failures.append("bot did not drain within --drain-timeout")
+    return failures
+
+
+def print_report(report):
+    print(f"updates        {report['updates_processed']}/{report['updates_sent']} processed, "
+          f"HTTP {report['http_statuses']}, {report['text_shed']:.0f} text shed")
+    print(f"throughput     {report['throughput_per_second']} updates/s")
+    latency = report["latency_ms"]
+    print(f"latency        p50 {latency['p50']} ms  p95 {latency['p95']} ms  p99 {latency['p99']} ms")
+    visible = report["tap_visible_ms"]
+    print(f"tap visible    p50 {visible['p50']} ms  p95 {visible['p95']} ms  p99 {visible['p99']} ms "
+          f"({report['taps_without_edit']} taps with no edit after)")
+    response = report["webhook_response_ms"]
+    print(f"webhook reply  p50 {response['p50']} ms  p95 {response['p95']} ms  p99 {response['p99']} ms")
+    print(f"DB calls       {report['db_calls_per_update']} per update")
+    print(f"API calls      {report['api_calls_per_update']} per update "
+          f"(+{report['inline_answers_per_update']} inline answers) {report['api_calls_by_method']}")
+    print(f"edits          {report['edits_skipped']:.0f} skipped, {report['edits_superseded']:.0f} superseded, "
+          f"{report['edits_replaced']:.0f} replaced while queued")
+
+# ======================
+# MAIN
+# ======================
+def reset_database(database_url):
+    import psycopg2
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn, conn.cursor() as c:
+            c.execute("SELECT to_regclass('balances') IS NOT NULL")
+            if c.fetchone()[0]:
+                c.execute("""
+                    TRUNCATE balances, balance_deltas, pending_transactions, ledger,
+                             conversation_state, processed_updates
+                """)
+    finally:
+        conn.close()
+
+
+def load_bot(args, workdir):
+    """Import swear_jar_bot configured for webhook mode against the fake API."""
+    os.environ.update(
+        BOT_TOKEN="123456:loadtest",
+        DATABASE_URL=args.database_url,
+        WEBHOOK_URL=f"http://127.0.0.1:{args.port}",
+        PORT=str(args.port),
+        TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{args.api_port}/bot",
+        JOURNAL_PATH=os.path.join(workdir, "update_journal.db"),
+        OFFLINE_BUFFER_PATH=os.path.join(workdir, "offline_writes.db"),
+    )
+    if not args.telegram_limits:
+        # Telegram's per-chat limits would make the run measure the rate limiter
+        # rather than the bot; explicit env settings still win
+        for name in ("API_GLOBAL_PER_SECOND", "API_GROUP_PER_MINUTE", "API_PRIVATE_PER_SECOND", "API_CHAT_BURST"):
+            os.environ.setdefault(name, "100000")
+    bot = importlib.import_module("swear_jar_bot")
+    # Synthetic members aren't on the allow-list
+    bot.ALLOWED_USERS.clear()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    return bot
+
+
+def load_bot_for_db(database_url, workers):
+    """Import swear_jar_bot for the scripts that only call its DB functions
+    (stress_confirm.py, bench_balances.py, scoreboard_queries.py), with
+    `workers` pooled connections and executor threads so that many calls can
+    run at once."""
+    os.environ.update(
+        DATABASE_URL=database_url,
+        DB_POOL_MAX=str(workers),
+        DB_WORKERS=str(workers),
+    )
+    return importlib.import_module("swear_jar_bot")
+
+
+def scratch_chat_id():
+    """A chat id no earlier run used. Scripts that write to one of these
+    leave other chats alone, so a shared scratch database is fine."""
+    return -(time.time_ns() // 1000 % 10**12)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database-url", default=os.getenv("LOADTEST_DATABASE_URL"),
+                        help="scratch Postgres the bot may write to (default: $LOADTEST_DATABASE_URL)")
+    parser.add_argument("--reset", action="store_true", help="truncate the bot's tables before the run")
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--users", type=int, default=4, help="members per chat")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=0, help="updates per second (0: as fast as possible)")
+    parser.add_argument("--connections", type=int, default=40, help="concurrent webhook requests")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--replay", help="JSONL file of Telegram updates to send instead")
+    parser.add_argument("--save", help="write the update stream sent to this JSONL file")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="delay added by the fake Bot API")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="keep the bot's production outbound rate limits")
+    parser.add_argument("--port", type=int, default=18443, help="webhook port")
+    parser.add_argument("--api-port", type=int, default=18081, help="fake Bot API port")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--settle-seconds", type=float, default=1)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    parser.add_argument("--max-p95-ms", type=float)
+    parser.add_argument("--max-p99-ms", type=float)
+    parser.add_argument("--max-tap-visible-p95-ms", type=float)
+    parser.add_argument("--min-throughput", type=float)
+    parser.add_argument("--max-db-per-update", type=float)
+    parser.add_argument("--max-api-per-update", type=float)
+    args = parser.parse_args(argv)
+    if not args.database_url:
+        parser.error("--database-url (or LOADTEST_DATABASE_URL) is required")
+    return args
+
+
+async def main_async(args):
+    if args.replay:
+        with open(args.replay) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = synthetic_updates(chat_members(args.chats, args.users), args.updates, args.seed)
+    # Warmup takes the low ids
+    updates = number_updates(updates, first_id=1_000_000)
+    if args.save:
+        with open(args.save, "w") as f:
+            for update in updates:
+                f.write(json.dumps(update) + "\n")
+
+    if args.reset:
+        reset_database(args.database_url)
+
+    fake_api = FakeBotApi(args.api_latency_ms)
+    await fake_api.start(args.api_port)
+    with tempfile.TemporaryDirectory(prefix="swearjar-load-") as workdir:
+        bot = load_bot(args, workdir)
+        bot_task = asyncio.create_task(bot.run())
+        try:
+            report = await run_load(args, bot, fake_api, updates)
+        finally:
+            bot_task.cancel()
+            try:
+                await bot_task
+            except asyncio.CancelledError:
+                pass
+            await fake_api.stop()
+    return report
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failures = check_gates(args, report)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
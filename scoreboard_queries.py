@@ -0,0 +1,96 @@
+"""Scoreboard query count as a chat's membership grows.
+
+Renders the scoreboard (cache bypassed) of chats with each --members count,
+every member having a balance and some a pending swear, and counts the
+statements and pooled connections one render costs. The render must stay a
+single aggregated query however many members there are; the run exits
+non-zero if the count changes with membership.
+
+    python scoreboard_queries.py --database-url postgresql://localhost/swearjar_load
+"""
+import sys
+import asyncio
+import argparse
+from contextlib import contextmanager
+from loadtest import load_bot_for_db, scratch_chat_id
+
+
+class CountingCursor:
+    def __init__(self, cursor, counts):
+        self._cursor = cursor
+        self._counts = counts
+
+    def execute(self, *args, **kwargs):
+        self._counts["statements"] += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def count_queries(bot):
+    """Make every db_cursor() count into the returned dict."""
+    counts = {"statements": 0, "connections": 0}
+    db_cursor = bot.db_cursor
+
+    @contextmanager
+    def counting_cursor():
+        counts["connections"] += 1
+        with db_cursor() as c:
+            yield CountingCursor(c, counts)
+
+    bot.db_cursor = counting_cursor
+    return counts
+
+
+async def render_costs(args, bot):
+    """{members: (statements, connections, rows rendered)}"""
+    await asyncio.to_thread(bot.init_pool)
+    try:
+        await asyncio.get_running_loop().run_in_executor(bot.db_executor, bot.init_db)
+        counts = count_queries(bot)
+        costs = {}
+        for members in args.members:
+            chat_id = scratch_chat_id()
+            taps = {user_id: (f"Member{user_id}", bot.SWEAR_CENTS, 0) for user_id in range(1, members + 1)}
+            await bot.run_db(bot.apply_taps, chat_id, taps)
+            for user_id in range(1, members + 1, 3):
+                await bot.run_db(bot.insert_pending, 0, "Proxy", user_id, chat_id, bot.SWEAR_CENTS)
+
+            bot.invalidate_scoreboard(chat_id)
+            counts.update(statements=0, connections=0)
+            text, _ = await bot.get_scoreboard(chat_id)
+            costs[members] = (counts["statements"], counts["connections"], text.count("\n") - 2)
+        return costs
+    finally:
+        await asyncio.to_thread(bot.close_pool)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database-url", required=True, help="scratch Postgres the bot may migrate")
+    parser.add_argument("--members", default="1,10,100", help="chat sizes to render")
+    args = parser.parse_args(argv)
+    args.members = [int(members) for members in args.members.split(",")]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bot = load_bot_for_db(args.database_url, 2)
+    costs = asyncio.run(render_costs(args, bot))
+
+    failures = []
+    for members, (statements, connections, rows) in costs.items():
+        print(f"{members:5} members: {statements} statement(s) on {connections} connection(s), {rows} rows rendered")
+        if rows != members:
+            failures.append(f"{members} members rendered as {rows} rows")
+    if len({(statements, connections) for statements, connections, _ in costs.values()}) > 1:
+        failures.append("query count changes with membership")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
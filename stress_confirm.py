@@ -0,0 +1,102 @@
+"""Concurrency stress test: no ➕/➖ tap or pending confirmation is lost.
+
+Seeds one member with a balance, then in parallel (through run_db(), as the
+handlers do) applies ➕ taps, ➖ taps that take the locking clamp path, and
+races several confirmations of every pending transaction. Afterwards each
+pending transaction must have been credited exactly once, and the balance
+must equal both the arithmetic total and the member's ledger sum.
+
+    python stress_confirm.py --database-url postgresql://localhost/swearjar_load
+"""
+import sys
+import time
+import asyncio
+import argparse
+from loadtest import load_bot_for_db, scratch_chat_id
+
+SEED_CENTS = 100_000
+
+
+def member_totals(c, chat_id, user_id):
+    """(balance including deltas, ledger sum, pending left) for one member."""
+    c.execute("""
+        SELECT
+            (SELECT amount_cents FROM balances WHERE telegram_id = %(user_id)s AND chat_id = %(chat_id)s)
+            + (SELECT COALESCE(SUM(amount_cents), 0) FROM balance_deltas
+               WHERE telegram_id = %(user_id)s AND chat_id = %(chat_id)s),
+            (SELECT COALESCE(SUM(amount_cents), 0) FROM ledger
+             WHERE telegram_id = %(user_id)s AND chat_id = %(chat_id)s),
+            (SELECT COUNT(*) FROM pending_transactions WHERE to_user_id = %(user_id)s AND chat_id = %(chat_id)s)
+    """, {"chat_id": chat_id, "user_id": user_id})
+    return c.fetchone()
+
+
+async def stress(args, bot):
+    await asyncio.to_thread(bot.init_pool)
+    try:
+        await asyncio.get_running_loop().run_in_executor(bot.db_executor, bot.init_db)
+        chat_id = scratch_chat_id()
+        member, proposer = 1, 2
+        swear = bot.SWEAR_CENTS
+
+        await bot.run_db(bot.apply_taps, chat_id, {member: ("Member", SEED_CENTS, 0)})
+        for _ in range(args.pending):
+            await bot.run_db(bot.insert_pending, proposer, "Proposer", member, chat_id, swear)
+        pending = [row[0] for row in await bot.run_db(bot.fetch_pending_for_user, member, chat_id)]
+
+        async def confirm(transaction_id):
+            return await bot.run_db(bot.confirm_pending, transaction_id, member, "Member", chat_id)
+
+        jobs = [bot.run_db(bot.apply_taps, chat_id, {member: ("Member", swear, 0)}) for _ in range(args.plus)]
+        # The balance stays far above 0, so the clamp never bites and the
+        # outcome is exact, but shift < floor still takes the locking path
+        jobs += [bot.run_db(bot.apply_taps, chat_id, {member: ("Member", -swear, 0)}) for _ in range(args.minus)]
+        jobs += [confirm(transaction_id) for transaction_id in pending for _ in range(args.confirmers)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        elapsed = time.perf_counter() - started
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        confirmed = sum(1 for result in results[args.plus + args.minus:] if result is True)
+        balance, ledger, left = await bot.run_db(member_totals, chat_id, member)
+        expected = SEED_CENTS + swear * (args.plus - args.minus + args.pending)
+    finally:
+        await asyncio.to_thread(bot.close_pool)
+
+    print(f"{len(jobs)} concurrent writes in {elapsed:.2f}s: {confirmed}/{args.pending} pending confirmed "
+          f"({args.confirmers} racing each), {left} left, {len(errors)} errors")
+    print(f"balance {balance}, expected {expected}, ledger {ledger}")
+    failures = []
+    if errors:
+        failures.append(f"{len(errors)} writes failed, first: {errors[0]!r}")
+    if confirmed != args.pending or left:
+        failures.append(f"{confirmed} confirmations succeeded for {args.pending} pending ({left} left)")
+    if balance != expected:
+        failures.append(f"balance {balance} != expected {expected}")
+    if balance != ledger:
+        failures.append(f"balance {balance} != ledger {ledger}")
+    return failures
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database-url", required=True, help="scratch Postgres the bot may migrate")
+    parser.add_argument("--workers", type=int, default=16, help="DB pool size and executor threads")
+    parser.add_argument("--plus", type=int, default=400, help="➕ taps")
+    parser.add_argument("--minus", type=int, default=200, help="➖ taps")
+    parser.add_argument("--pending", type=int, default=100, help="pending transactions to confirm")
+    parser.add_argument("--confirmers", type=int, default=4, help="concurrent confirmations of each")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bot = load_bot_for_db(args.database_url, args.workers)
+    failures = asyncio.run(stress(args, bot))
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,38 @@
 import psycopg2
+import psycopg2.pool
 import os
+import sys
+import json
+import sqlite3
+import time
+import random
+import signal
 import asyncio
 import logging
+import functools
+import httpx
+from bisect import bisect_left
+from collections import deque
+from cachetools import LRUCache, TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from aiohttp import web
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    PersistenceInput,
     ContextTypes,
     filters
 )
@@ -23,6 +43,110 @@ from telegram.ext import (
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Connection pool bounds and per-statement timeout (milliseconds)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+# Threads running blocking DB calls (capped at DB_POOL_MAX) and the
+# threshold above which a call is logged as slow
+DB_WORKERS = int(os.getenv("DB_WORKERS", str(DB_POOL_MAX)))
+DB_SLOW_QUERY_MS = int(os.getenv("DB_SLOW_QUERY_MS", "500"))
+# Connection attempts give up after DB_CONNECT_TIMEOUT seconds. A call that
+# can't reach Postgres is tried DB_RETRY_ATTEMPTS times with jittered
+# exponential backoff from DB_RETRY_BASE_MS, never waiting more than
+# DB_RETRY_MAX_SECONDS between tries.
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "3"))
+DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", "3"))
+DB_RETRY_BASE_MS = int(os.getenv("DB_RETRY_BASE_MS", "100"))
+DB_RETRY_MAX_SECONDS = float(os.getenv("DB_RETRY_MAX_SECONDS", "30"))
+
+# In webhook mode, how long the webhook response waits for a button's
+# answerCallbackQuery so it can be returned inline instead of sent as a
+# separate Bot API request. 0 always sends it separately.
+INLINE_REPLY_WAIT_MS = int(os.getenv("INLINE_REPLY_WAIT_MS", "250"))
+
+# Local SQLite file holding taps, settles and proxy adds made while Postgres
+# is unreachable, until they can be replayed
+OFFLINE_BUFFER_PATH = os.getenv("OFFLINE_BUFFER_PATH", "offline_writes.db")
+
+# Rendered scoreboards kept per chat (entries, seconds)
+SCOREBOARD_CACHE_SIZE = int(os.getenv("SCOREBOARD_CACHE_SIZE", "1000"))
+SCOREBOARD_CACHE_TTL = float(os.getenv("SCOREBOARD_CACHE_TTL", "300"))
+# Messages whose current text + keyboard is remembered to skip no-op edits
+MESSAGE_FINGERPRINTS = int(os.getenv("MESSAGE_FINGERPRINTS", "10000"))
+
+# ➕/➖ taps in a chat are batched for this long before one write + one edit.
+# 0 applies every tap immediately.
+TAP_COALESCE_MS = int(os.getenv("TAP_COALESCE_MS", "400"))
+
+# Updates processed at once across all chats (updates in one chat still run
+# one at a time, in order)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+
+# Outbound Bot API calls: base URL (point it at a stand-in server to load
+# test), keep-alive connections shared by concurrent handlers, timeouts in
+# seconds, and opt-in HTTP/2 (needs `pip install "python-telegram-bot[http2]"`).
+# Long polling gets its own single connection so it never holds one of these.
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", str(MAX_CONCURRENT_UPDATES)))
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "5"))
+API_READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "10"))
+API_WRITE_TIMEOUT = float(os.getenv("API_WRITE_TIMEOUT", "10"))
+API_POOL_TIMEOUT = float(os.getenv("API_POOL_TIMEOUT", "3"))
+API_KEEPALIVE_SECONDS = float(os.getenv("API_KEEPALIVE_SECONDS", "60"))
+API_HTTP2 = os.getenv("API_HTTP2", "").lower() in ("1", "true", "yes")
+
+# Outbound rate limits, kept under Telegram's: messages per second overall,
+# per minute in one group, per second in one private chat, and how many a
+# chat may send back to back. A 429 is retried up to API_MAX_RETRIES times
+# after the wait Telegram asks for.
+API_GLOBAL_PER_SECOND = float(os.getenv("API_GLOBAL_PER_SECOND", "30"))
+API_GROUP_PER_MINUTE = float(os.getenv("API_GROUP_PER_MINUTE", "20"))
+API_PRIVATE_PER_SECOND = float(os.getenv("API_PRIVATE_PER_SECOND", "1"))
+API_CHAT_BURST = int(os.getenv("API_CHAT_BURST", "5"))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
+
+# Recent webhook update_ids remembered to drop Telegram's retries. Set
+# DEDUP_PERSIST=1 to also claim each id in Postgres (survives restarts and
+# works across instances, at one insert per update). While Postgres is down
+# updates are still accepted, deduplicated only by this instance's window
+# and journal, so a retry landing on another instance may run twice.
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "10000"))
+DEDUP_PERSIST = os.getenv("DEDUP_PERSIST", "").lower() in ("1", "true", "yes")
+
+# Local SQLite file the webhook appends raw updates to before acknowledging
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "update_journal.db")
+
+# Load shedding: past SHED_TEXT_AT unprocessed updates, plain text messages
+# are dropped; past UPDATE_QUEUE_MAX, the webhook answers 503 so Telegram
+# redelivers later. PTB's update queue is bounded by UPDATE_QUEUE_MAX too.
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "1000"))
+SHED_TEXT_AT = int(os.getenv("SHED_TEXT_AT", str(UPDATE_QUEUE_MAX // 2)))
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "5"))
+
+# GET /ready: DB ping timeout, backlog limit, how stale the last successful
+# Bot API call may get before it is re-checked, and how long a result is reused
+READY_DB_TIMEOUT = float(os.getenv("READY_DB_TIMEOUT", "1"))
+READY_MAX_BACKLOG = int(os.getenv("READY_MAX_BACKLOG", str(UPDATE_QUEUE_MAX // 2)))
+READY_MAX_API_AGE = float(os.getenv("READY_MAX_API_AGE", "300"))
+READY_CACHE_SECONDS = float(os.getenv("READY_CACHE_SECONDS", "5"))
+
+# Proxy-add flow state is written to Postgres at most once per
+# STATE_FLUSH_SECONDS (and on shutdown); flows untouched for
+# CONVERSATION_STATE_TTL seconds are discarded
+STATE_FLUSH_SECONDS = float(os.getenv("STATE_FLUSH_SECONDS", "10"))
+CONVERSATION_STATE_TTL = int(os.getenv("CONVERSATION_STATE_TTL", "3600"))
+# Proxy flows held in memory at once (least recently used are abandoned
+# first) and how often abandoned flows and idle user_data are swept
+PROXY_FLOWS_MAX = int(os.getenv("PROXY_FLOWS_MAX", "1000"))
+PROXY_SWEEP_SECONDS = float(os.getenv("PROXY_SWEEP_SECONDS", "60"))
+
+# Increments to a balance land in one of BALANCE_STRIPES delta rows so
+# concurrent writers to one member don't queue on a single row lock; the
+# deltas are folded back into balances every BALANCE_COMPACT_SECONDS
+BALANCE_STRIPES = int(os.getenv("BALANCE_STRIPES", "8"))
+BALANCE_COMPACT_SECONDS = float(os.getenv("BALANCE_COMPACT_SECONDS", "60"))
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO
@@ -36,23 +160,266 @@ ALLOWED_USERS = {
     468551427   # Natalie
 }
 
+# Every amount is handled as integer cents; dollars only exist in rendered text
+SWEAR_CENTS = 5
+
+# ======================
+# METRICS
+# ======================
+# Rendered at GET /metrics in the Prometheus text format. Everything is
+# observed on the event loop thread, so plain ints need no locking.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        # label value -> [count per bucket..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, label_value, seconds):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        series[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        series[-1] += seconds
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for label_value, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), series):
+                cumulative += count
+                yield f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}'
+            yield f'{self.name}_sum{{{self.label}="{label_value}"}} {series[-1]}'
+            yield f'{self.name}_count{{{self.label}="{label_value}"}} {cumulative}'
+
+
+class Counter:
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+
+    def inc(self, label_value):
+        self._values[label_value] = self._values.get(label_value, 0) + 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for label_value, value in self._values.items():
+            yield f'{self.name}{{{self.label}="{label_value}"}} {value}'
+
+
+handler_seconds = Histogram("swearjar_handler_seconds", "Time spent in each update handler.", "handler")
+callback_seconds = Histogram("swearjar_callback_seconds", "Button handling time per callback route.", "route")
+callback_rejected = Counter("swearjar_callbacks_rejected_total", "Button presses not dispatched.", "reason")
+db_seconds = Histogram("swearjar_db_seconds", "DB call time including executor wait.", "statement")
+db_retries = Counter("swearjar_db_retries_total", "DB calls retried after Postgres was unreachable.", "statement")
+api_seconds = Histogram("swearjar_telegram_api_seconds", "Bot API request time.", "method")
+api_errors = Counter("swearjar_telegram_api_errors_total", "Failed Bot API requests.", "method")
+handler_errors = Counter("swearjar_handler_errors_total", "Errors reaching error_handler.", "error")
+# time.monotonic() of the last Bot API call that got a response below 400
+api_last_success = None
+
+def instrument_handler(handler):
+    """Time a PTB handler."""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            handler_seconds.observe(handler.__name__, time.perf_counter() - started)
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and failures per Bot API method."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint == "answerCallbackQuery" and take_inline_answer(kwargs.get("request_data")):
+            return 200, b'{"ok":true,"result":true}'
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            api_errors.inc(endpoint)
+            raise
+        finally:
+            api_seconds.observe(endpoint, time.perf_counter() - started)
+        if code >= 400:
+            api_errors.inc(endpoint)
+        else:
+            global api_last_success
+            api_last_success = time.monotonic()
+        return code, payload
+
 # ======================
 # DATABASE SETUP
 # ======================
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+# One pool per process, created in run(). Blocking psycopg2 calls run on a
+# dedicated executor so handlers never stall the event loop.
+db_pool = None
+db_executor = None
+pool_stats = {"checkouts": 0, "in_use": 0, "max_in_use": 0, "errors": 0}
 
-def init_db():
+
+def init_pool():
+    global db_pool, db_executor
     if not DATABASE_URL:
         raise ValueError("DATABASE_URL environment variable not set")
-    conn = get_db_connection()
-    c = conn.cursor()
+    # Opens DB_POOL_MIN connections up front, so the first taps after a
+    # (re)start don't pay for TCP + auth.
+    db_pool = psycopg2.pool.ThreadedConnectionPool(
+        DB_POOL_MIN,
+        DB_POOL_MAX,
+        DATABASE_URL,
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    )
+    # At most one worker per pooled connection: a checkout can never find the
+    # pool exhausted, excess work just queues on the executor.
+    workers = min(DB_WORKERS, DB_POOL_MAX)
+    if workers < DB_WORKERS:
+        logger.warning("DB_WORKERS=%d exceeds DB_POOL_MAX, using %d", DB_WORKERS, workers)
+    db_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+    logger.info("DB pool ready (min=%d, max=%d, workers=%d)", DB_POOL_MIN, DB_POOL_MAX, workers)
+
+
+def close_pool():
+    if db_executor:
+        db_executor.shutdown(wait=True)
+    if db_pool:
+        db_pool.closeall()
+
+
+def pool_metrics():
+    return {
+        **pool_stats,
+        "idle": len(db_pool._pool) if db_pool else 0,
+        "open": len(db_pool._pool) + len(db_pool._used) if db_pool else 0,
+    }
+
+
+class DatabaseUnavailable(Exception):
+    """Postgres couldn't be reached, and nothing was committed."""
+
+
+@contextmanager
+def db_cursor():
+    """Check out a pooled connection, commit on success, roll back on error."""
+    try:
+        conn = db_pool.getconn()
+    except psycopg2.OperationalError as e:
+        pool_stats["errors"] += 1
+        raise DatabaseUnavailable(str(e)) from e
+    pool_stats["checkouts"] += 1
+    pool_stats["in_use"] += 1
+    pool_stats["max_in_use"] = max(pool_stats["max_in_use"], pool_stats["in_use"])
+    committing = False
+    try:
+        with conn.cursor() as c:
+            yield c
+        committing = True
+        conn.commit()
+    except Exception as e:
+        pool_stats["errors"] += 1
+        if not conn.closed:
+            conn.rollback()
+        # Lost before COMMIT was sent, so the transaction can safely be
+        # retried. A connection lost during COMMIT may or may not have
+        # applied it; that surfaces as the original error.
+        if conn.closed and not committing and isinstance(e, psycopg2.Error):
+            raise DatabaseUnavailable(str(e)) from e
+        raise
+    finally:
+        pool_stats["in_use"] -= 1
+        # Broken connections are discarded instead of going back to the pool
+        db_pool.putconn(conn, close=bool(conn.closed))
+
+
+def _call_with_cursor(fn, args):
+    with db_cursor() as c:
+        return fn(c, *args)
+
+
+async def run_db(fn, *args):
+    """Run fn(cursor, *args) in one transaction on the DB executor.
+
+    This is the only way handlers touch Postgres, so a slow query occupies a
+    worker thread while the loop keeps serving other chats and /health.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    # While writes are being buffered Postgres is known to be down: fail
+    # fast and leave probing to the replay loop
+    attempts = 1 if offline_writes is not None and offline_writes.pending else DB_RETRY_ATTEMPTS
+    try:
+        for attempt in range(attempts):
+            try:
+                return await loop.run_in_executor(db_executor, _call_with_cursor, fn, args)
+            except DatabaseUnavailable:
+                if attempt + 1 >= attempts:
+                    raise
+                db_retries.inc(fn.__name__)
+                await asyncio.sleep(backoff_delay(attempt))
+    finally:
+        elapsed = loop.time() - started
+        db_seconds.observe(fn.__name__, elapsed)
+        elapsed_ms = elapsed * 1000
+        if elapsed_ms > DB_SLOW_QUERY_MS:
+            logger.warning("Slow DB call %s took %.0f ms", fn.__name__, elapsed_ms)
+
+
+def backoff_delay(attempt):
+    """Seconds to wait before retry number attempt + 1: exponential, jittered."""
+    delay = min(DB_RETRY_MAX_SECONDS, DB_RETRY_BASE_MS / 1000 * 2 ** attempt)
+    # Spread retries out so instances don't hit a recovering DB in lockstep
+    return delay * random.uniform(0.5, 1.0)
+
+
+async def run_db_write(chat_id, fn, *args):
+    """run_db() for statements that change what chat_id's scoreboard shows.
+
+    Writes listed in BUFFERED_WRITES are kept in the offline buffer instead
+    of failing when Postgres is unreachable, and return None.
+    """
+    # Taps still in their coalescing window came first, so they land first
+    if fn is not apply_taps and chat_id in pending_taps:
+        await flush_taps(chat_id, 0)
+    try:
+        if offline_writes is None or fn.__name__ not in BUFFERED_WRITES:
+            return await run_db(fn, *args)
+        # Queue behind anything already buffered to keep the chat's order
+        if offline_writes.pending:
+            offline_writes.append(chat_id, fn, args)
+            return None
+        try:
+            return await run_db(fn, *args)
+        except DatabaseUnavailable as e:
+            logger.warning("Postgres unavailable, buffering %s for chat %s: %s", fn.__name__, chat_id, e)
+            offline_writes.append(chat_id, fn, args)
+            return None
+    finally:
+        invalidate_scoreboard(chat_id)
+
+
+# ======================
+# SCHEMA MIGRATIONS
+# ======================
+def create_base_tables(c):
     c.execute("""
     CREATE TABLE IF NOT EXISTS balances (
         telegram_id BIGINT,
         chat_id BIGINT,
         name TEXT,
-        amount DECIMAL DEFAULT 0,
+        amount_cents BIGINT DEFAULT 0,
         PRIMARY KEY (telegram_id, chat_id)
     )
     """)
@@ -63,17 +430,500 @@ def init_db():
         from_user_name TEXT,
         to_user_id BIGINT,
         chat_id BIGINT,
-        amount DECIMAL,
+        amount_cents BIGINT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     """)
-    conn.commit()
-    c.close()
-    conn.close()
+
+
+def migrate_amounts_to_cents(c):
+    """One-shot conversion of the old DECIMAL dollar columns to BIGINT cents."""
+    for table in ("balances", "pending_transactions"):
+        c.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'amount'
+        """, (table,))
+        if not c.fetchone():
+            continue
+        c.execute(f"""
+            ALTER TABLE {table}
+            ALTER COLUMN amount TYPE BIGINT USING ROUND(amount * 100)
+        """)
+        c.execute(f"ALTER TABLE {table} RENAME COLUMN amount TO amount_cents")
+        logger.info("Migrated %s.amount to integer cents", table)
+
+
+def create_ledger(c):
+    """Append-only history of every balance change.
+
+    kind is one of 'swear' (➕/➖ taps), 'proxy' (confirmed proxy add),
+    'settle' or 'correction'. balances.amount_cents is kept equal to the sum
+    of a member's ledger rows by writing both in the same transaction.
+    """
+    c.execute("SELECT to_regclass('ledger')")
+    if c.fetchone()[0] is not None:
+        return
+    c.execute("""
+    CREATE TABLE ledger (
+        id BIGSERIAL PRIMARY KEY,
+        chat_id BIGINT NOT NULL,
+        telegram_id BIGINT NOT NULL,
+        kind TEXT NOT NULL,
+        amount_cents BIGINT NOT NULL,
+        actor_id BIGINT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # Open the ledger with the balances that predate it
+    c.execute("""
+        INSERT INTO ledger (chat_id, telegram_id, kind, amount_cents)
+        SELECT chat_id, telegram_id, 'correction', amount_cents
+        FROM balances
+        WHERE amount_cents <> 0
+    """)
+    logger.info("Created ledger with %d opening balances", c.rowcount)
+
+
+def add_lookup_indexes(c):
+    # Scoreboard: balances of one chat, highest first
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS balances_chat_amount_idx
+        ON balances (chat_id, amount_cents DESC)
+    """)
+    # Scoreboard pending aggregation
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS pending_chat_to_user_idx
+        ON pending_transactions (chat_id, to_user_id)
+    """)
+    # /start: a member's pending swears in arrival order
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS pending_to_user_chat_created_idx
+        ON pending_transactions (to_user_id, chat_id, created_at)
+    """)
+    # Per-member history
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS ledger_chat_user_idx
+        ON ledger (chat_id, telegram_id, id)
+    """)
+
+
+def create_processed_updates(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id BIGINT PRIMARY KEY,
+        seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def create_conversation_state(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS conversation_state (
+        user_id BIGINT PRIMARY KEY,
+        data JSONB NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def create_balance_deltas(c):
+    # A member's balance is balances.amount_cents plus the sum of their
+    # deltas; see add_to_balance()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS balance_deltas (
+        telegram_id BIGINT,
+        chat_id BIGINT,
+        stripe SMALLINT,
+        amount_cents BIGINT NOT NULL,
+        PRIMARY KEY (telegram_id, chat_id, stripe)
+    )
+    """)
+
+
+# Applied in order, each in its own transaction, and recorded in
+# schema_version. Append new migrations; never edit one that has shipped.
+MIGRATIONS = [
+    (1, create_base_tables),
+    (2, migrate_amounts_to_cents),
+    (3, create_ledger),
+    (4, add_lookup_indexes),
+    (5, create_processed_updates),
+    (6, create_conversation_state),
+    (7, create_balance_deltas),
+]
+
+# Arbitrary key for pg_advisory_xact_lock so concurrent instances don't
+# run the same migration twice
+MIGRATION_LOCK_ID = 0x5EA4
+
+
+def init_db():
+    """Bring the schema up to date. Costs one query when already current."""
+    with db_cursor() as c:
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        SELECT COALESCE(MAX(version), 0) FROM schema_version
+        """)
+        current = c.fetchone()[0]
+
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        with db_cursor() as c:
+            c.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            c.execute("SELECT 1 FROM schema_version WHERE version = %s", (version,))
+            if c.fetchone():
+                continue
+            migration(c)
+            c.execute(
+                "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                (version, migration.__name__)
+            )
+        logger.info("Applied schema migration %d (%s)", version, migration.__name__)
+
+# ======================
+# QUERIES
+# ======================
+# Each takes a cursor as its first argument and is called via run_db().
+def fetch_scoreboard(c, chat_id):
+    """Balances with each member's pending total, in a single round trip."""
+    c.execute("""
+        SELECT b.name, b.amount_cents + COALESCE(d.delta_cents, 0) AS amount_cents, p.pending_cents
+        FROM balances b
+        LEFT JOIN (
+            SELECT telegram_id, SUM(amount_cents)::BIGINT AS delta_cents
+            FROM balance_deltas
+            WHERE chat_id = %(chat_id)s
+            GROUP BY telegram_id
+        ) d ON d.telegram_id = b.telegram_id
+        LEFT JOIN (
+            SELECT to_user_id, SUM(amount_cents)::BIGINT AS pending_cents
+            FROM pending_transactions
+            WHERE chat_id = %(chat_id)s
+            GROUP BY to_user_id
+        ) p ON p.to_user_id = b.telegram_id
+        WHERE b.chat_id = %(chat_id)s
+        ORDER BY 2 DESC
+    """, {"chat_id": chat_id})
+    return c.fetchall()
+
+
+def fetch_pending_for_user(c, user_id, chat_id):
+    c.execute("""
+        SELECT id, from_user_name, amount_cents
+        FROM pending_transactions
+        WHERE to_user_id = %s AND chat_id = %s
+        ORDER BY created_at
+    """, (user_id, chat_id))
+    return c.fetchall()
+
+
+def fetch_other_users(c, chat_id, user_id):
+    c.execute("""
+        SELECT telegram_id, name
+        FROM balances
+        WHERE chat_id = %s AND telegram_id != %s
+        ORDER BY name
+    """, (chat_id, user_id))
+    return c.fetchall()
+
+
+def fetch_user_name(c, telegram_id, chat_id):
+    c.execute("""
+        SELECT name FROM balances WHERE telegram_id = %s AND chat_id = %s
+    """, (telegram_id, chat_id))
+    result = c.fetchone()
+    return result[0] if result else "Unknown"
+
+
+def insert_pending(c, from_user_id, from_user_name, to_user_id, chat_id, amount_cents):
+    c.execute("""
+        INSERT INTO pending_transactions (from_user_id, from_user_name, to_user_id, chat_id, amount_cents)
+        VALUES (%s, %s, %s, %s, %s)
+    """, (from_user_id, from_user_name, to_user_id, chat_id, amount_cents))
+
+
+# Writes that only add to a balance go to a delta row picked by the
+# connection's backend pid, so pooled connections writing to the same member
+# rarely share a row. Writes that can clamp or reset a balance need its true
+# value: they lock the balances row first, then fold the deltas into it in
+# the same round trip.
+#
+# Lock order, so writers and compaction can't deadlock each other: a
+# transaction takes every balances row lock it needs before touching any
+# balance_deltas row, and takes each kind in (chat_id, telegram_id) order.
+def add_to_balance(c, user_id, chat_id, name, amount_cents):
+    """Add a non-negative amount as a 'swear' without locking the balance row."""
+    c.execute("""
+        INSERT INTO balances (telegram_id, chat_id, name, amount_cents)
+        VALUES (%(user_id)s, %(chat_id)s, %(name)s, 0)
+        ON CONFLICT (telegram_id, chat_id) DO NOTHING;
+
+        INSERT INTO balance_deltas (telegram_id, chat_id, stripe, amount_cents)
+        SELECT %(user_id)s, %(chat_id)s, pg_backend_pid() %% %(stripes)s, %(amount)s
+        WHERE %(amount)s <> 0
+        ON CONFLICT (telegram_id, chat_id, stripe) DO UPDATE
+        SET amount_cents = balance_deltas.amount_cents + EXCLUDED.amount_cents;
+
+        INSERT INTO ledger (chat_id, telegram_id, kind, amount_cents, actor_id)
+        SELECT %(chat_id)s, %(user_id)s, 'swear', %(amount)s, %(user_id)s
+        WHERE %(amount)s <> 0
+    """, {"user_id": user_id, "chat_id": chat_id, "name": name, "amount": amount_cents,
+          "stripes": BALANCE_STRIPES})
+
+
+def settle_balance(c, user_id, chat_id):
+    c.execute("""
+        SELECT 1 FROM balances
+        WHERE telegram_id = %(user_id)s AND chat_id = %(chat_id)s
+        FOR UPDATE;
+
+        WITH merged AS (
+            DELETE FROM balance_deltas
+            WHERE telegram_id = %(user_id)s AND chat_id = %(chat_id)s
+            RETURNING amount_cents
+        ), settled AS (
+            UPDATE balances b
+            SET amount_cents = 0
+            FROM (
+                SELECT telegram_id, chat_id,
+                       amount_cents + (SELECT COALESCE(SUM(amount_cents), 0) FROM merged) AS amount_cents
+                FROM balances
+                WHERE telegram_id = %(user_id)s AND chat_id = %(chat_id)s
+            ) old
+            WHERE b.telegram_id = old.telegram_id AND b.chat_id = old.chat_id
+            RETURNING old.amount_cents AS before
+        )
+        INSERT INTO ledger (chat_id, telegram_id, kind, amount_cents, actor_id)
+        SELECT %(chat_id)s, %(user_id)s, 'settle', -before, %(user_id)s
+        FROM settled
+        WHERE before <> 0
+    """, {"user_id": user_id, "chat_id": chat_id})
+
+
+def confirm_pending(c, transaction_id, user_id, user_name, chat_id):
+    """Move a pending transaction into the balance. Returns False if not found.
+
+    One statement: the DELETE claims the row, so of two concurrent
+    confirmations only one sees it and credits the balance. The credit is
+    an increment, so it goes to a delta row like add_to_balance().
+    """
+    c.execute("""
+        WITH claimed AS (
+            DELETE FROM pending_transactions
+            WHERE id = %(transaction_id)s AND to_user_id = %(user_id)s AND chat_id = %(chat_id)s
+            RETURNING from_user_id, to_user_id, amount_cents
+        ), ensured AS (
+            INSERT INTO balances (telegram_id, chat_id, name, amount_cents)
+            SELECT to_user_id, %(chat_id)s, %(user_name)s, 0
+            FROM claimed
+            ON CONFLICT (telegram_id, chat_id) DO NOTHING
+            RETURNING 1
+        ), credited AS (
+            INSERT INTO balance_deltas (telegram_id, chat_id, stripe, amount_cents)
+            SELECT to_user_id, %(chat_id)s, pg_backend_pid() %% %(stripes)s, amount_cents
+            FROM claimed
+            -- Postgres runs unreferenced CTEs last to first; reading ensured
+            -- makes the balances row come before the delta row
+            WHERE (SELECT COUNT(*) FROM ensured) >= 0
+            ON CONFLICT (telegram_id, chat_id, stripe) DO UPDATE
+            SET amount_cents = balance_deltas.amount_cents + EXCLUDED.amount_cents
+        )
+        INSERT INTO ledger (chat_id, telegram_id, kind, amount_cents, actor_id)
+        SELECT %(chat_id)s, to_user_id, 'proxy', amount_cents, from_user_id
+        FROM claimed
+    """, {"transaction_id": transaction_id, "user_id": user_id, "user_name": user_name,
+          "chat_id": chat_id, "stripes": BALANCE_STRIPES})
+    return c.rowcount > 0
+
+
+def reject_pending(c, transaction_id, user_id, chat_id):
+    c.execute("""
+        DELETE FROM pending_transactions
+        WHERE id = %s AND to_user_id = %s AND chat_id = %s
+    """, (transaction_id, user_id, chat_id))
+
+
+def apply_taps(c, chat_id, taps):
+    """Apply coalesced taps: {user_id: (name, shift, floor)}.
+
+    Each user's run of +/- taps collapses to new = GREATEST(old + shift, floor),
+    which is exactly what applying GREATEST(amount_cents + delta, 0) once per tap
+    would have produced. Balances never go below 0, so when shift >= floor the
+    clamp can't bite and the batch is a plain increment.
+
+    Rows for every member are created, and those of members who may clamp
+    locked, before any delta is written; then members are handled in id order.
+    """
+    user_ids = sorted(taps)
+    clamped = [user_id for user_id in user_ids if taps[user_id][1] < taps[user_id][2]]
+    c.execute("""
+        INSERT INTO balances (telegram_id, chat_id, name, amount_cents)
+        SELECT telegram_id, %(chat_id)s, name, 0
+        FROM unnest(%(user_ids)s::BIGINT[], %(names)s::TEXT[]) AS t (telegram_id, name)
+        ORDER BY telegram_id
+        ON CONFLICT (telegram_id, chat_id) DO NOTHING;
+
+        SELECT 1 FROM balances
+        WHERE chat_id = %(chat_id)s AND telegram_id = ANY(%(clamped)s::BIGINT[])
+        ORDER BY telegram_id
+        FOR UPDATE
+    """, {"chat_id": chat_id, "user_ids": user_ids, "names": [taps[user_id][0] for user_id in user_ids],
+          "clamped": clamped})
+
+    for user_id in user_ids:
+        name, shift, floor = taps[user_id]
+        if shift >= floor:
+            add_to_balance(c, user_id, chat_id, name, shift)
+            continue
+
+        c.execute("""
+            WITH merged AS (
+                DELETE FROM balance_deltas
+                WHERE telegram_id = %(user_id)s AND chat_id = %(chat_id)s
+                RETURNING amount_cents
+            ), changed AS (
+                UPDATE balances b
+                SET amount_cents = GREATEST(old.amount_cents + %(shift)s, %(floor)s)
+                FROM (
+                    SELECT telegram_id, chat_id,
+                           amount_cents + (SELECT COALESCE(SUM(amount_cents), 0) FROM merged) AS amount_cents
+                    FROM balances
+                    WHERE telegram_id = %(user_id)s AND chat_id = %(chat_id)s
+                ) old
+                WHERE b.telegram_id = old.telegram_id AND b.chat_id = old.chat_id
+                RETURNING old.amount_cents AS before, b.amount_cents AS after
+            )
+            INSERT INTO ledger (chat_id, telegram_id, kind, amount_cents, actor_id)
+            SELECT %(chat_id)s, %(user_id)s, 'swear', after - before, %(user_id)s
+            FROM changed
+            WHERE after <> before
+        """, {"user_id": user_id, "chat_id": chat_id, "shift": shift, "floor": floor})
+
+
+def compact_balance_deltas(c):
+    """Fold every member's deltas into balances. Returns the rows merged."""
+    c.execute("""
+        SELECT b.telegram_id, b.chat_id FROM balances b
+        WHERE EXISTS (
+            SELECT 1 FROM balance_deltas d
+            WHERE d.telegram_id = b.telegram_id AND d.chat_id = b.chat_id
+        )
+        ORDER BY b.chat_id, b.telegram_id
+        FOR UPDATE OF b
+    """)
+    locked = c.fetchall()
+    if not locked:
+        return 0
+    # Only members whose balance row is locked, and only the delta rows
+    # locked here, in the order writers take them. Rows written since are
+    # left for the next run; deleting them too would wait on their writers
+    # out of order.
+    c.execute("""
+        WITH locked AS (
+            SELECT telegram_id, chat_id, stripe FROM balance_deltas
+            WHERE (telegram_id, chat_id) IN (
+                SELECT * FROM unnest(%s::BIGINT[], %s::BIGINT[])
+            )
+            ORDER BY chat_id, telegram_id, stripe
+            FOR UPDATE
+        ), merged AS (
+            DELETE FROM balance_deltas d
+            USING locked l
+            WHERE d.telegram_id = l.telegram_id AND d.chat_id = l.chat_id AND d.stripe = l.stripe
+            RETURNING d.telegram_id, d.chat_id, d.amount_cents
+        )
+        UPDATE balances b
+        SET amount_cents = b.amount_cents + m.total
+        FROM (
+            SELECT telegram_id, chat_id, SUM(amount_cents)::BIGINT AS total
+            FROM merged
+            GROUP BY telegram_id, chat_id
+        ) m
+        WHERE b.telegram_id = m.telegram_id AND b.chat_id = m.chat_id
+    """, ([user_id for user_id, _ in locked], [chat_id for _, chat_id in locked]))
+    return c.rowcount
+
+
+def claim_update(c, update_id):
+    """Record update_id as seen. Returns False if it already was."""
+    c.execute("""
+        INSERT INTO processed_updates (update_id) VALUES (%s)
+        ON CONFLICT (update_id) DO NOTHING
+    """, (update_id,))
+    claimed = c.rowcount == 1
+    # Telegram stops retrying long before a day is up; trim now and then
+    if claimed and update_id % 1000 == 0:
+        c.execute("""
+            DELETE FROM processed_updates
+            WHERE seen_at < CURRENT_TIMESTAMP - INTERVAL '1 day'
+        """)
+    return claimed
+
+
+def release_update(c, update_id):
+    """Undo claim_update() for an update that couldn't be journaled."""
+    c.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
+
+
+def load_conversation_state(c, ttl_seconds):
+    """Drop expired flows and return {user_id: state} for the rest."""
+    c.execute("""
+        DELETE FROM conversation_state
+        WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s);
+        SELECT user_id, data FROM conversation_state
+    """, (ttl_seconds,))
+    return dict(c.fetchall())
+
+
+def save_conversation_state(c, states, ttl_seconds):
+    """Upsert non-empty states and delete emptied ones in one round trip.
+
+    Expired flows are swept in the same statement batch.
+    """
+    kept = {user_id: state for user_id, state in states.items() if state}
+    emptied = [user_id for user_id, state in states.items() if not state]
+    c.execute("""
+        INSERT INTO conversation_state (user_id, data)
+        SELECT * FROM unnest(%s::BIGINT[], %s::JSONB[])
+        ON CONFLICT (user_id) DO UPDATE
+        SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP;
+        DELETE FROM conversation_state
+        WHERE user_id = ANY(%s::BIGINT[])
+           OR updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+    """, (list(kept), [json.dumps(state) for state in kept.values()], emptied, ttl_seconds))
+
+
+def rebuild_balances(c):
+    """Recompute every balance from the ledger. Returns the number corrected."""
+    # Hold off concurrent writers so no ledger row lands mid-rebuild
+    c.execute("LOCK TABLE balances, balance_deltas, ledger IN SHARE ROW EXCLUSIVE MODE")
+    compact_balance_deltas(c)
+    c.execute("""
+        WITH totals AS (
+            SELECT chat_id, telegram_id, SUM(amount_cents)::BIGINT AS total
+            FROM ledger
+            GROUP BY chat_id, telegram_id
+        )
+        UPDATE balances b
+        SET amount_cents = COALESCE(t.total, 0)
+        FROM balances cur
+        LEFT JOIN totals t ON t.chat_id = cur.chat_id AND t.telegram_id = cur.telegram_id
+        WHERE b.chat_id = cur.chat_id AND b.telegram_id = cur.telegram_id
+          AND b.amount_cents IS DISTINCT FROM COALESCE(t.total, 0)
+    """)
+    return c.rowcount
 
 # ======================
 # UI HELPERS
 # ======================
+def format_cents(cents):
+    return f"${cents // 100}.{cents % 100:02d}"
+
 def get_keyboard():
     return InlineKeyboardMarkup([
         [
@@ -101,62 +951,547 @@ def get_proxy_amount_keyboard():
 
 
 def get_proxy_amount_text(to_user_name, swear_count):
-    amount = swear_count * 0.05
     return (
         f"How many swears to add for {to_user_name}?\n\n"
         f"Swears: {swear_count}\n"
-        f"Amount: ${amount:.2f}\n\n"
+        f"Amount: {format_cents(swear_count * SWEAR_CENTS)}\n\n"
         "Use ➕ / ➖, then tap Confirm."
     )
 
-def get_scoreboard(chat_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""
-        SELECT name, amount
-        FROM balances
-        WHERE chat_id = %s
-        ORDER BY amount DESC
-    """, (chat_id,))
-    rows = c.fetchall()
-    
-    # Get pending transactions
-    c.execute("""
-        SELECT to_user_id, SUM(amount)
-        FROM pending_transactions
-        WHERE chat_id = %s
-        GROUP BY to_user_id
-    """, (chat_id,))
-    pending = dict(c.fetchall())
-    
-    c.close()
-    conn.close()
+# ======================
+# MESSAGE EDITS
+# ======================
+# (chat_id, message_id) -> fingerprint of what the bot last put there. Every
+# send and edit goes through here, so an edit that wouldn't change anything
+# (Back on the scoreboard, ➖ at $0) is skipped instead of costing an API
+# call and a "message is not modified" error.
+message_fingerprints = LRUCache(maxsize=MESSAGE_FINGERPRINTS)
+edit_stats = {"sent": 0, "skipped": 0, "replaced": 0, "failed": 0}
+
+# Edits are sent in the background, one message at a time, so a handler
+# never holds its chat's lock while an edit waits for a rate-limit token.
+# (chat_id, message_id) -> (text, markup) newest view not yet sent; a newer
+# edit replaces it, so a message that falls behind skips straight to its
+# latest state.
+queued_edits = {}
+# (chat_id, message_id) -> task sending that message's queued edits
+edit_senders = {}
+
+
+def view_fingerprint(text, markup):
+    return hash((text, json.dumps(markup.to_dict(), sort_keys=True) if markup else None))
+
+
+def remember_view(message, text, markup):
+    message_fingerprints[(message.chat_id, message.message_id)] = view_fingerprint(text, markup)
+
+
+def edit_message(bot, chat_id, message_id, text, markup):
+    """Queue an edit of the message to text + markup."""
+    key = (chat_id, message_id)
+    if key in queued_edits:
+        edit_stats["replaced"] += 1
+    queued_edits[key] = (text, markup)
+    if key not in edit_senders:
+        edit_senders[key] = asyncio.create_task(send_queued_edits(bot, key))
+
 
+async def send_queued_edits(bot, key):
+    try:
+        while key in queued_edits:
+            text, markup = queued_edits.pop(key)
+            try:
+                await send_edit(bot, key, text, markup)
+            except TelegramError as e:
+                # Deleted, too old to edit, or out of retries
+                edit_stats["failed"] += 1
+                logger.warning("Could not edit message %s in chat %s: %s", key[1], key[0], e)
+            except Exception:
+                edit_stats["failed"] += 1
+                logger.exception("Could not edit message %s in chat %s", key[1], key[0])
+    finally:
+        del edit_senders[key]
+
+
+async def send_edit(bot, key, text, markup):
+    chat_id, message_id = key
+    fingerprint = view_fingerprint(text, markup)
+    if message_fingerprints.get(key) == fingerprint:
+        edit_stats["skipped"] += 1
+        return
+    # Unknown until this edit lands
+    message_fingerprints.pop(key, None)
+    try:
+        result = await bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id, reply_markup=markup)
+    except BadRequest as e:
+        # Shown already, e.g. edited before a restart cleared the fingerprints
+        if "not modified" not in str(e):
+            raise
+        result = None
+    edit_stats["sent"] += 1
+    # True means ApiScheduler dropped it for a newer edit, which records its own
+    if result is not True:
+        message_fingerprints[key] = fingerprint
+
+
+def edit_query_message(query, text, markup):
+    """Show text + markup on the message whose button was pressed."""
+    edit_message(query.get_bot(), query.message.chat_id, query.message.message_id, text, markup)
+
+# ======================
+# SCOREBOARD CACHE
+# ======================
+# chat_id -> (text, markup). Only writes through run_db_write() evict an
+# entry, so navigation between views is served without touching Postgres.
+scoreboard_cache = TTLCache(maxsize=SCOREBOARD_CACHE_SIZE, ttl=SCOREBOARD_CACHE_TTL)
+scoreboard_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+# Bumped on every invalidation; a render that raced with a write is not cached
+scoreboard_writes = 0
+# chat_id -> rows of the last scoreboard read, shown while Postgres is down
+last_scoreboard_rows = LRUCache(maxsize=SCOREBOARD_CACHE_SIZE)
+
+
+def invalidate_scoreboard(chat_id):
+    global scoreboard_writes
+    scoreboard_writes += 1
+    scoreboard_cache_stats["invalidations"] += 1
+    scoreboard_cache.pop(chat_id, None)
+
+
+def render_scoreboard(rows):
     if not rows:
         return "Swear Jar\n\nNo swears yet 😇"
 
     text = "Swear Jar\n\n"
-    for name, amount in rows:
-        pending_text = ""
-        if rows[0][1]:  # If there are any pending for this user
-            # Find pending for this specific user by checking their name
-            c = get_db_connection().cursor()
-            c.execute("""
-                SELECT telegram_id FROM balances WHERE name = %s AND chat_id = %s
-            """, (name, chat_id))
-            result = c.fetchone()
-            if result:
-                user_id = result[0]
-                if user_id in pending:
-                    pending_text = f" + (${pending[user_id]} pending)"
-            c.close()
-        
-        text += f"{name}: ${amount}{pending_text}\n"
+    for name, amount_cents, pending_cents in rows:
+        pending_text = f" + ({format_cents(pending_cents)} pending)" if pending_cents else ""
+        text += f"{name}: {format_cents(amount_cents)}{pending_text}\n"
     return text
 
+
+async def get_scoreboard(chat_id):
+    """Return the scoreboard view for chat_id as (text, markup)."""
+    view = scoreboard_cache.get(chat_id)
+    if view is not None:
+        scoreboard_cache_stats["hits"] += 1
+        return view
+
+    scoreboard_cache_stats["misses"] += 1
+    writes_before = scoreboard_writes
+    try:
+        rows = await run_db(fetch_scoreboard, chat_id)
+    except DatabaseUnavailable:
+        return render_stale_scoreboard(chat_id)
+    last_scoreboard_rows[chat_id] = rows
+    view = (render_scoreboard(rows), get_keyboard())
+    if scoreboard_writes == writes_before:
+        scoreboard_cache[chat_id] = view
+    return view
+
+
+def render_stale_scoreboard(chat_id):
+    """The last scoreboard read, flagged as out of date. Never cached."""
+    rows = last_scoreboard_rows.get(chat_id)
+    text = render_scoreboard(rows) if rows is not None else "Swear Jar\n"
+    queued = offline_writes.pending_by_chat.get(chat_id, 0) if offline_writes else 0
+    text += "\n⚠️ Database offline, showing last known totals"
+    if queued:
+        text += f" ({queued} change{'s' if queued != 1 else ''} queued)"
+    return text, get_keyboard()
+
+
+async def show_scoreboard(query, chat_id):
+    text, markup = await get_scoreboard(chat_id)
+    edit_query_message(query, text, markup)
+
+# ======================
+# TAP COALESCING
+# ======================
+# chat_id -> {user_id: (name, shift, floor)} waiting to be written
+pending_taps = {}
+# chat_id -> {message_id: query} scoreboards to refresh after the write
+pending_tap_queries = {}
+# chat_id -> update_ids of the batch's journaled taps, acked after the write
+pending_tap_acks = {}
+
+
+def queue_tap(query, delta):
+    """Fold one ➕/➖ tap into its chat's batch. Returns True if it opened the batch."""
+    chat_id = query.message.chat_id
+    user = query.from_user
+    opened = chat_id not in pending_taps
+    taps = pending_taps.setdefault(chat_id, {})
+    _, shift, floor = taps.get(user.id, (None, 0, 0))
+    # max(max(x + shift, floor) + delta, 0) == max(x + shift + delta, max(floor + delta, 0))
+    taps[user.id] = (user.first_name, shift + delta, max(floor + delta, 0))
+    pending_tap_queries.setdefault(chat_id, {})[query.message.message_id] = query
+    if update_journal is not None:
+        update_id = update_journal.defer_ack(query.id)
+        if update_id is not None:
+            pending_tap_acks.setdefault(chat_id, []).append(update_id)
+    return opened
+
+
+async def flush_taps(chat_id, delay):
+    await asyncio.sleep(delay)
+    # Another write or button press in this chat may already have drained the batch
+    taps = pending_taps.pop(chat_id, None)
+    queries = pending_tap_queries.pop(chat_id, {})
+    acks = pending_tap_acks.pop(chat_id, [])
+    if not taps:
+        return
+    # If this raises, the taps stay journaled and are applied on the next startup
+    await run_db_write(chat_id, apply_taps, chat_id, taps)
+    for update_id in acks:
+        update_journal.ack(update_id)
+    for query in queries.values():
+        await show_scoreboard(query, chat_id)
+
+# ======================
+# OFFLINE WRITES
+# ======================
+class OfflineWriteBuffer:
+    """Writes made while Postgres is unreachable, replayed in order once it's back.
+
+    Only writes whose result the handler doesn't need are buffered (see
+    BUFFERED_WRITES). Entries live in a local SQLite file, so a restart
+    during an outage doesn't lose them; a restart between a replayed write's
+    commit and its removal here would apply it a second time. A write that
+    fails in a way retrying can't fix is moved to the dead_writes table,
+    with its error, for someone to look at.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+        CREATE TABLE IF NOT EXISTS writes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            fn TEXT NOT NULL,
+            args TEXT NOT NULL
+        )
+        """)
+        self._db.execute("""
+        CREATE TABLE IF NOT EXISTS dead_writes (
+            seq INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            fn TEXT NOT NULL,
+            args TEXT NOT NULL,
+            error TEXT NOT NULL,
+            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        # chat_id -> writes waiting, for the stale scoreboard
+        self.pending_by_chat = dict(
+            self._db.execute("SELECT chat_id, COUNT(*) FROM writes GROUP BY chat_id").fetchall()
+        )
+        self.pending = sum(self.pending_by_chat.values())
+        self.buffered = 0
+        self.replayed = 0
+        self.dead = self._db.execute("SELECT COUNT(*) FROM dead_writes").fetchone()[0]
+        self._replay_task = None
+
+    def append(self, chat_id, fn, args):
+        self._db.execute(
+            "INSERT INTO writes (chat_id, fn, args) VALUES (?, ?, ?)",
+            (chat_id, fn.__name__, json.dumps(args))
+        )
+        self.pending += 1
+        self.pending_by_chat[chat_id] = self.pending_by_chat.get(chat_id, 0) + 1
+        self.buffered += 1
+        self.start_replay()
+
+    def start_replay(self):
+        if self.pending and self._replay_task is None:
+            self._replay_task = asyncio.create_task(self._replay())
+
+    async def _replay(self):
+        if self.pending:
+            logger.info("Replaying %d buffered writes once Postgres is reachable", self.pending)
+        attempt = 0
+        try:
+            while True:
+                row = self._db.execute(
+                    "SELECT seq, chat_id, fn, args FROM writes ORDER BY seq LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return
+                seq, chat_id, name, args = row
+                try:
+                    fn, decode = BUFFERED_WRITES[name]
+                    await run_db(fn, *decode(json.loads(args)))
+                except (DatabaseUnavailable, psycopg2.OperationalError) as e:
+                    # Postgres is still down, or the transaction was rolled
+                    # back by a deadlock, serialization failure or timeout:
+                    # the same write can succeed later
+                    if not isinstance(e, DatabaseUnavailable):
+                        logger.warning("Buffered write %s failed, retrying: %s", name, e)
+                    await asyncio.sleep(backoff_delay(attempt))
+                    attempt += 1
+                    continue
+                except Exception as e:
+                    # Retrying won't fix it, and it would hold up everything behind it
+                    logger.exception("Moving buffered write %s %s to dead_writes", name, args)
+                    self._bury(seq, e)
+                else:
+                    self.replayed += 1
+                self._remove(seq, chat_id)
+                invalidate_scoreboard(chat_id)
+                attempt = 0
+        finally:
+            self._replay_task = None
+
+    def _bury(self, seq, error):
+        self._db.execute("""
+            INSERT OR REPLACE INTO dead_writes (seq, chat_id, fn, args, error)
+            SELECT seq, chat_id, fn, args, ? FROM writes WHERE seq = ?
+        """, (repr(error), seq))
+        self.dead += 1
+
+    def _remove(self, seq, chat_id):
+        self._db.execute("DELETE FROM writes WHERE seq = ?", (seq,))
+        self.pending -= 1
+        remaining = self.pending_by_chat[chat_id] - 1
+        if remaining:
+            self.pending_by_chat[chat_id] = remaining
+        else:
+            del self.pending_by_chat[chat_id]
+
+    def close(self):
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+        self._db.close()
+
+
+def decode_tap_args(args):
+    # JSON turned the user ids into strings and the tap tuples into lists
+    chat_id, taps = args
+    return chat_id, {int(user_id): tuple(tap) for user_id, tap in taps.items()}
+
+
+# fn name -> (fn, turns the JSON-decoded args back into fn's arguments)
+BUFFERED_WRITES = {
+    "apply_taps": (apply_taps, decode_tap_args),
+    "settle_balance": (settle_balance, tuple),
+    "insert_pending": (insert_pending, tuple),
+}
+
+# Created in run()
+offline_writes = None
+
+# ======================
+# BALANCE COMPACTION
+# ======================
+compaction_stats = {"rows_merged": 0}
+
+
+async def compact_balances_periodically():
+    # Scoreboard totals don't change, so cached renders stay valid
+    while True:
+        await asyncio.sleep(BALANCE_COMPACT_SECONDS)
+        try:
+            compaction_stats["rows_merged"] += await run_db(compact_balance_deltas)
+        except Exception:
+            logger.exception("Balance compaction failed")
+
+# ======================
+# CONVERSATION STATE
+# ======================
+# The only context.user_data keys that outlive a restart
+PROXY_STATE_KEYS = (
+    "proxy_to_user_id", "proxy_to_user_name", "proxy_swear_count",
+    "proxy_chat_id", "proxy_message_id"
+)
+
+
+class ConversationStatePersistence(BasePersistence):
+    """Keep the proxy-add flow in Postgres so a restart doesn't strand it.
+
+    PTB's in-memory user_data stays the working copy: handlers read and write
+    it as before, and PTB passes changed users here every STATE_FLUSH_SECONDS
+    and on shutdown. Only PROXY_STATE_KEYS are stored, entries that match
+    what was last written are skipped, and each cycle's changes go out in a
+    single round trip, so ➕/➖ presses never wait on a write.
+    """
+
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=STATE_FLUSH_SECONDS
+        )
+        # user_id -> state as it is in Postgres
+        self._stored = {}
+        # user_id -> state still to write; {} deletes the row
+        self._dirty = {}
+        self._write_task = None
+
+    async def get_user_data(self):
+        self._stored = await run_db(load_conversation_state, CONVERSATION_STATE_TTL)
+        return {user_id: dict(state) for user_id, state in self._stored.items()}
+
+    async def update_user_data(self, user_id, data):
+        state = {key: data[key] for key in PROXY_STATE_KEYS if key in data}
+        if state == self._stored.get(user_id, {}):
+            self._dirty.pop(user_id, None)
+            return
+        self._dirty[user_id] = state
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_soon())
+
+    async def drop_user_data(self, user_id):
+        await self.update_user_data(user_id, {})
+
+    async def _write_soon(self):
+        try:
+            # PTB hands over every changed user in one gather; let the rest
+            # of this cycle land in the batch first
+            await asyncio.sleep(0)
+            await self._write_dirty()
+        except Exception:
+            # Unwritten entries stay dirty for the next cycle or shutdown
+            logger.exception("Failed to save conversation state")
+        finally:
+            self._write_task = None
+
+    async def _write_dirty(self):
+        while self._dirty:
+            batch, self._dirty = self._dirty, {}
+            try:
+                await run_db(save_conversation_state, batch, CONVERSATION_STATE_TTL)
+            except Exception:
+                # Changes made meanwhile are newer than the failed batch
+                self._dirty = {**batch, **self._dirty}
+                raise
+            for user_id, state in batch.items():
+                if state:
+                    self._stored[user_id] = state
+                else:
+                    self._stored.pop(user_id, None)
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_dirty()
+
+    # Memory is authoritative while running; nothing else is persisted
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# ======================
+# PROXY FLOW EXPIRY
+# ======================
+class ProxyFlowCache(TTLCache):
+    """TTLCache that keeps the keys it evicts for sweep_user_data()."""
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self.evicted = []
+
+    def expire(self, time=None):
+        # Returns the expired pairs since cachetools 5.5 (see requirements.txt)
+        expired = super().expire(time)
+        self.evicted.extend(key for key, _ in expired)
+        return expired
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.evicted.append(key)
+        return key, value
+
+
+# user_id of every proxy flow in progress; each ➕/➖ renews the TTL
+proxy_flows = ProxyFlowCache(PROXY_FLOWS_MAX, CONVERSATION_STATE_TTL)
+sweep_stats = {"flows_expired": 0, "user_data_dropped": 0}
+
+
+def track_proxy_flow(user_id):
+    proxy_flows[user_id] = True
+
+
+async def expire_proxy_flows(ptb_app):
+    """Abandon timed-out or evicted flows, then drop idle user_data.
+
+    PTB creates a user_data entry for every user it sees, so only entries
+    holding a tracked flow are kept. An abandoned flow's message is edited
+    back to the scoreboard so its buttons don't act on forgotten state.
+    """
+    proxy_flows.expire()
+    stale, proxy_flows.evicted = proxy_flows.evicted, []
+    for user_id in stale:
+        if user_id in proxy_flows:
+            # Started a new flow since
+            continue
+        state = ptb_app.user_data.get(user_id, {})
+        if "proxy_to_user_id" not in state:
+            continue
+        ptb_app.drop_user_data(user_id)
+        sweep_stats["flows_expired"] += 1
+        if state.get("proxy_message_id"):
+            await reset_proxy_message(ptb_app.bot, state["proxy_chat_id"], state["proxy_message_id"])
+
+    for user_id, data in list(ptb_app.user_data.items()):
+        if user_id in proxy_flows:
+            continue
+        if "proxy_to_user_id" in data:
+            # Restored from Postgres after a restart
+            track_proxy_flow(user_id)
+        else:
+            ptb_app.drop_user_data(user_id)
+            sweep_stats["user_data_dropped"] += 1
+
+
+async def reset_proxy_message(bot, chat_id, message_id):
+    text, markup = await get_scoreboard(chat_id)
+    edit_message(bot, chat_id, message_id, text, markup)
+
+
+async def sweep_user_data(ptb_app):
+    while True:
+        await asyncio.sleep(PROXY_SWEEP_SECONDS)
+        try:
+            await expire_proxy_flows(ptb_app)
+        except Exception:
+            logger.exception("User data sweep failed")
+
 # ======================
 # COMMANDS
 # ======================
+@instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Run once to create & pin the swear jar message
@@ -166,350 +1501,352 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("/start received from user_id=%s chat_id=%s", user_id, chat_id)
     
     # Check for pending transactions for this user
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, from_user_name, amount
-        FROM pending_transactions
-        WHERE to_user_id = %s AND chat_id = %s
-        ORDER BY created_at
-    """, (user_id, chat_id))
-    pending = c.fetchall()
-    c.close()
-    conn.close()
+    pending = await run_db(fetch_pending_for_user, user_id, chat_id)
     
     # If user has pending transactions, show them first
     if pending:
         pending_text = "You have pending swears to confirm:\n\n"
-        for trans_id, from_user_name, amount in pending:
-            pending_text += f"{from_user_name} wants to add ${amount}\n"
+        for trans_id, from_user_name, amount_cents in pending:
+            pending_text += f"{from_user_name} wants to add {format_cents(amount_cents)}\n"
         
         buttons = []
-        for trans_id, from_user_name, amount in pending:
+        for trans_id, from_user_name, amount_cents in pending:
             buttons.append([
-                InlineKeyboardButton(f"Accept ${amount} from {from_user_name}", callback_data=f"confirm_pending_{trans_id}"),
+                InlineKeyboardButton(f"Accept {format_cents(amount_cents)} from {from_user_name}", callback_data=f"confirm_pending_{trans_id}"),
                 InlineKeyboardButton("Reject", callback_data=f"reject_pending_{trans_id}")
             ])
         buttons.append([InlineKeyboardButton("Back to Scoreboard", callback_data="back_to_scoreboard")])
+        markup = InlineKeyboardMarkup(buttons)
         
-        await update.message.reply_text(
-            pending_text,
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
+        context.application.create_task(send_reply(update.message, pending_text, markup), update=update)
         return
     
     # Normal flow - show scoreboard
-    message = await update.message.reply_text(
-        get_scoreboard(chat_id),
-        reply_markup=get_keyboard()
-    )
+    text, markup = await get_scoreboard(chat_id)
+    context.application.create_task(send_reply(update.message, text, markup, pin=True), update=update)
+
+
+# Replies go out after the handler returns, like edits, so the chat's next
+# updates don't wait while a reply waits for a rate-limit token
+async def send_reply(message, text, markup=None, pin=False):
+    reply = await message.reply_text(text, reply_markup=markup)
+    remember_view(reply, text, markup)
+    if not pin:
+        return
 
     # Try to pin the message (fails silently if no permission)
     try:
-        await context.bot.pin_chat_message(
-            chat_id=update.effective_chat.id,
-            message_id=message.message_id
+        await reply.get_bot().pin_chat_message(
+            chat_id=reply.chat_id,
+            message_id=reply.message_id
         )
     except:
         pass
 
 # ======================
-# BUTTON HANDLER
+# CALLBACK ROUTER
 # ======================
+# Button presses are dispatched by dict lookup: exact callback_data first,
+# then the text before a trailing "_<id>" with the id parsed as an int.
+# Either way the cost doesn't grow with the number of buttons.
+exact_routes = {}
+prefix_routes = {}
+
+# Ids of callback queries already answered; Telegram rejects a second answer
+answered_queries = LRUCache(maxsize=10000)
+
+
+def claim_answer(callback_query_id):
+    """Mark the query answered. Returns False if it already was."""
+    if callback_query_id in answered_queries:
+        return False
+    answered_queries[callback_query_id] = True
+    return True
+
+
+async def answer_query(query, text=None, show_alert=False):
+    """Answer query unless it already was."""
+    if claim_answer(query.id):
+        await send_answer(query, text, show_alert)
+
+
+async def send_answer(query, text=None, show_alert=False):
+    # A failed answer (typically "query is too old") is only logged, so the
+    # press it belongs to is still handled
+    try:
+        await query.answer(text, show_alert=show_alert)
+    except TelegramError as e:
+        logger.warning("Couldn't answer callback query %s: %s", query.id, e)
+
+
+# Early answers still being sent; referenced so they aren't collected
+early_answer_tasks = set()
+
+
+def early_answer(data, user_id):
+    """answerCallbackQuery parameters for a press whose answer doesn't depend
+    on its handler (unknown, unauthorized or answers=False), else None."""
+    resolved = resolve_callback(data or "")
+    if resolved is None:
+        return {}
+    _, (_, auth, answers), _ = resolved
+    if auth and ALLOWED_USERS and user_id not in ALLOWED_USERS:
+        return {"text": "Not authorized", "show_alert": True}
+    return None if answers else {}
+
+
+def start_early_answer(query):
+    """Answer query in the background if early_answer() allows it.
+
+    Called before the update waits for its chat, so a busy chat doesn't
+    make the button spin until Telegram gives up on the answer.
+    """
+    answer = early_answer(query.data, query.from_user.id)
+    if answer is None or not claim_answer(query.id):
+        return
+    task = asyncio.create_task(send_answer(query, **answer))
+    early_answer_tasks.add(task)
+    task.add_done_callback(early_answer_tasks.discard)
+
+
+def callback_route(data=None, prefix=None, auth=True, answers=False):
+    """Register fn(query, context, chat_id[, id]) for a button.
+
+    auth=True limits the route to ALLOWED_USERS (when configured). The query
+    is answered before fn runs unless answers=True, in which case fn answers
+    it with answer_query() (typically because it may show an alert). If fn
+    raises before answering, the query gets an error alert instead.
+    """
+    def register(fn):
+        if prefix:
+            prefix_routes[prefix] = (fn, auth, answers)
+        else:
+            exact_routes[data] = (fn, auth, answers)
+        return fn
+    return register
+
+
+def resolve_callback(data):
+    """Return (route name, (fn, auth, answers), params) or None for unknown data."""
+    route = exact_routes.get(data)
+    if route:
+        return data, route, ()
+    prefix, _, param = data.rpartition("_")
+    route = prefix_routes.get(prefix)
+    # isdecimal(), not isdigit(): "²" is a digit that int() rejects
+    if route and param.isdecimal():
+        return prefix, route, (int(param),)
+    return None
+
+
+@instrument_handler
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-
     user = query.from_user
     chat_id = query.message.chat_id
     logger.info("button '%s' from user_id=%s chat_id=%s", query.data, user.id, chat_id)
 
-    # Restrict users if configured
-    if ALLOWED_USERS and user.id not in ALLOWED_USERS:
-        await query.answer("Not authorized", show_alert=True)
+    # Every query is answered exactly once, as early as possible: that's
+    # what stops the button's spinner. Usually the webhook response or
+    # start_early_answer() has already done it, and this is a no-op.
+    answer = early_answer(query.data, user.id)
+    if answer is not None:
+        await answer_query(query, **answer)
+    resolved = resolve_callback(query.data or "")
+    if resolved is None:
+        callback_rejected.inc("unknown")
         return
+    name, (fn, auth, answers), params = resolved
 
-    # Handle proxy add start - show user selection
-    if query.data == "proxy_start":
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("""
-            SELECT telegram_id, name
-            FROM balances
-            WHERE chat_id = %s AND telegram_id != %s
-            ORDER BY name
-        """, (chat_id, user.id))
-        users = c.fetchall()
-        c.close()
-        conn.close()
-        
-        if not users:
-            await query.answer("No other users in this chat yet!", show_alert=True)
-            return
-        
-        # Create keyboard with user options
-        buttons = [[InlineKeyboardButton(name, callback_data=f"proxy_select_{uid}")] for uid, name in users]
-        buttons.append([InlineKeyboardButton("Cancel", callback_data="proxy_cancel")])
-        keyboard = InlineKeyboardMarkup(buttons)
-        
-        await query.edit_message_text(
-            text="Select who to add swears for:",
-            reply_markup=keyboard
-        )
-        return
-    
-    # Handle user selection in proxy add
-    if query.data.startswith("proxy_select_"):
-        to_user_id = int(query.data.split("_")[2])
-        # Store in context for next step
-        context.user_data['proxy_to_user_id'] = to_user_id
-        
-        # Get the name
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT name FROM balances WHERE telegram_id = %s", (to_user_id,))
-        result = c.fetchone()
-        to_user_name = result[0] if result else "Unknown"
-        c.close()
-        conn.close()
-
-        context.user_data['proxy_to_user_name'] = to_user_name
-        context.user_data['proxy_swear_count'] = 0
-        
-        # Show separate proxy amount picker view
-        await query.edit_message_text(
-            text=get_proxy_amount_text(to_user_name, 0),
-            reply_markup=get_proxy_amount_keyboard()
-        )
+    # Restrict users if configured
+    if auth and ALLOWED_USERS and user.id not in ALLOWED_USERS:
+        callback_rejected.inc("unauthorized")
         return
 
-    if query.data == "proxy_plus":
-        to_user_id = context.user_data.get('proxy_to_user_id')
-        to_user_name = context.user_data.get('proxy_to_user_name', 'Unknown')
-        if not to_user_id:
-            await query.answer("No proxy action in progress", show_alert=True)
-            return
+    # Taps still in their coalescing window came first; their scoreboard
+    # edit must not land on top of the view this press opens
+    if fn is not on_tap and chat_id in pending_taps:
+        await flush_taps(chat_id, 0)
 
-        swear_count = int(context.user_data.get('proxy_swear_count', 0)) + 1
-        context.user_data['proxy_swear_count'] = swear_count
-        await query.edit_message_text(
-            text=get_proxy_amount_text(to_user_name, swear_count),
-            reply_markup=get_proxy_amount_keyboard()
-        )
+    started = time.perf_counter()
+    try:
+        await fn(query, context, chat_id, *params)
+    except Exception:
+        # A no-op if fn answered before failing
+        await answer_query(query, "Something went wrong, please try again.", show_alert=True)
+        raise
+    finally:
+        callback_seconds.observe(name, time.perf_counter() - started)
+
+
+# Handle proxy add start - show user selection
+@callback_route("proxy_start", answers=True)
+async def on_proxy_start(query, context, chat_id):
+    users = await run_db(fetch_other_users, chat_id, query.from_user.id)
+
+    if not users:
+        await answer_query(query, "No other users in this chat yet!", show_alert=True)
         return
+    await answer_query(query)
 
-    if query.data == "proxy_minus":
-        to_user_id = context.user_data.get('proxy_to_user_id')
-        to_user_name = context.user_data.get('proxy_to_user_name', 'Unknown')
-        if not to_user_id:
-            await query.answer("No proxy action in progress", show_alert=True)
-            return
+    # Create keyboard with user options
+    buttons = [[InlineKeyboardButton(name, callback_data=f"proxy_select_{uid}")] for uid, name in users]
+    buttons.append([InlineKeyboardButton("Cancel", callback_data="proxy_cancel")])
+    keyboard = InlineKeyboardMarkup(buttons)
 
-        swear_count = max(int(context.user_data.get('proxy_swear_count', 0)) - 1, 0)
-        context.user_data['proxy_swear_count'] = swear_count
-        await query.edit_message_text(
-            text=get_proxy_amount_text(to_user_name, swear_count),
-            reply_markup=get_proxy_amount_keyboard()
-        )
-        return
+    edit_query_message(query, "Select who to add swears for:", keyboard)
 
-    if query.data == "proxy_confirm":
-        to_user_id = context.user_data.get('proxy_to_user_id')
-        to_user_name = context.user_data.get('proxy_to_user_name', 'Unknown')
-        swear_count = int(context.user_data.get('proxy_swear_count', 0))
 
-        if not to_user_id:
-            await query.answer("No proxy action in progress", show_alert=True)
-            return
+# Handle user selection in proxy add
+@callback_route(prefix="proxy_select")
+async def on_proxy_select(query, context, chat_id, to_user_id):
+    # Store in context for next step
+    context.user_data['proxy_to_user_id'] = to_user_id
+    context.user_data['proxy_chat_id'] = chat_id
+    context.user_data['proxy_message_id'] = query.message.message_id
+    track_proxy_flow(query.from_user.id)
 
-        if swear_count <= 0:
-            await query.answer("Please add at least 1 swear", show_alert=True)
-            return
+    # Get the name
+    to_user_name = await run_db(fetch_user_name, to_user_id, chat_id)
 
-        amount = swear_count * 0.05
+    context.user_data['proxy_to_user_name'] = to_user_name
+    context.user_data['proxy_swear_count'] = 0
 
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO pending_transactions (from_user_id, from_user_name, to_user_id, chat_id, amount)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (user.id, user.first_name, to_user_id, chat_id, amount))
+    # Show separate proxy amount picker view
+    edit_query_message(query, get_proxy_amount_text(to_user_name, 0), get_proxy_amount_keyboard())
 
-        conn.commit()
-        c.close()
-        conn.close()
-
-        # Clear context
-        context.user_data.pop('proxy_to_user_id', None)
-        context.user_data.pop('proxy_to_user_name', None)
-        context.user_data.pop('proxy_swear_count', None)
-        context.user_data.pop('awaiting_proxy_amount', None)
-
-        await query.edit_message_text(
-            text=get_scoreboard(chat_id),
-            reply_markup=get_keyboard()
-        )
-        await query.answer(f"Added {swear_count} swears (${amount:.2f}) pending for {to_user_name}", show_alert=True)
-        return
-    
-    # Handle proxy cancel
-    if query.data == "proxy_cancel":
-        context.user_data.pop('proxy_to_user_id', None)
-        context.user_data.pop('proxy_to_user_name', None)
-        context.user_data.pop('proxy_swear_count', None)
-        context.user_data.pop('awaiting_proxy_amount', None)
-        await query.edit_message_text(
-            text=get_scoreboard(chat_id),
-            reply_markup=get_keyboard()
-        )
-        return
 
-    # Handle settle up confirmation
-    if query.data == "settle":
-        confirm_keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("Yes, Settle Up", callback_data="settle_confirm"),
-                InlineKeyboardButton("Cancel", callback_data="settle_cancel")
-            ]
-        ])
-        await query.edit_message_text(
-            text=f"{get_scoreboard(chat_id)}\n\n{user.first_name}, reset your balance to $0?",
-            reply_markup=confirm_keyboard
-        )
-        return
+@callback_route("proxy_plus")
+async def on_proxy_plus(query, context, chat_id):
+    await adjust_proxy_count(query, context, chat_id, +1)
 
-    # Handle settle up confirmation
-    if query.data == "settle_confirm":
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("""
-            UPDATE balances
-            SET amount = 0
-            WHERE telegram_id = %s AND chat_id = %s
-        """, (user.id, chat_id))
-        conn.commit()
-        c.close()
-        conn.close()
-        await query.edit_message_text(
-            text=get_scoreboard(chat_id),
-            reply_markup=get_keyboard()
-        )
-        return
 
-    # Handle cancel
-    if query.data == "settle_cancel":
-        await query.edit_message_text(
-            text=get_scoreboard(chat_id),
-            reply_markup=get_keyboard()
-        )
-        return
+@callback_route("proxy_minus")
+async def on_proxy_minus(query, context, chat_id):
+    await adjust_proxy_count(query, context, chat_id, -1)
 
-    # Handle pending confirmation
-    if query.data.startswith("confirm_pending_"):
-        transaction_id = int(query.data.split("_")[2])
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # Get the pending transaction
-        c.execute("""
-            SELECT from_user_id, from_user_name, to_user_id, amount
-            FROM pending_transactions
-            WHERE id = %s AND to_user_id = %s AND chat_id = %s
-        """, (transaction_id, user.id, chat_id))
-        result = c.fetchone()
-        
-        if not result:
-            c.close()
-            conn.close()
-            await query.answer("Transaction not found or already processed", show_alert=True)
-            return
-        
-        from_user_id, from_user_name, to_user_id, amount = result
-        
-        # Update balance
-        c.execute("""
-            INSERT INTO balances (telegram_id, chat_id, name, amount)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (telegram_id, chat_id) DO UPDATE
-            SET amount = balances.amount + EXCLUDED.amount
-        """, (to_user_id, chat_id, user.first_name, amount))
-        
-        # Delete the pending transaction
-        c.execute("DELETE FROM pending_transactions WHERE id = %s", (transaction_id,))
-        
-        conn.commit()
-        c.close()
-        conn.close()
-        
-        await query.edit_message_text(
-            text=get_scoreboard(chat_id),
-            reply_markup=get_keyboard()
-        )
-        return
 
-    # Handle reject pending
-    if query.data.startswith("reject_pending_"):
-        transaction_id = int(query.data.split("_")[2])
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # Delete the pending transaction
-        c.execute("""
-            DELETE FROM pending_transactions
-            WHERE id = %s AND to_user_id = %s AND chat_id = %s
-        """, (transaction_id, user.id, chat_id))
-        
-        conn.commit()
-        c.close()
-        conn.close()
-        
-        await query.edit_message_text(
-            text=get_scoreboard(chat_id),
-            reply_markup=get_keyboard()
-        )
+async def adjust_proxy_count(query, context, chat_id, step):
+    to_user_id = context.user_data.get('proxy_to_user_id')
+    to_user_name = context.user_data.get('proxy_to_user_name', 'Unknown')
+    if not to_user_id:
+        # The flow expired or was finished elsewhere, so the picker is stale
+        await show_scoreboard(query, chat_id)
         return
 
-    # Handle back to scoreboard
-    if query.data == "back_to_scoreboard":
-        await query.edit_message_text(
-            text=get_scoreboard(chat_id),
-            reply_markup=get_keyboard()
-        )
+    swear_count = max(int(context.user_data.get('proxy_swear_count', 0)) + step, 0)
+    context.user_data['proxy_swear_count'] = swear_count
+    track_proxy_flow(query.from_user.id)
+    edit_query_message(query, get_proxy_amount_text(to_user_name, swear_count), get_proxy_amount_keyboard())
+
+
+def clear_proxy_state(context):
+    context.user_data.pop('proxy_to_user_id', None)
+    context.user_data.pop('proxy_to_user_name', None)
+    context.user_data.pop('proxy_swear_count', None)
+    context.user_data.pop('proxy_chat_id', None)
+    context.user_data.pop('proxy_message_id', None)
+    context.user_data.pop('awaiting_proxy_amount', None)
+
+
+@callback_route("proxy_confirm", answers=True)
+async def on_proxy_confirm(query, context, chat_id):
+    user = query.from_user
+    to_user_id = context.user_data.get('proxy_to_user_id')
+    to_user_name = context.user_data.get('proxy_to_user_name', 'Unknown')
+    swear_count = int(context.user_data.get('proxy_swear_count', 0))
+
+    if not to_user_id:
+        await answer_query(query, "No proxy action in progress", show_alert=True)
         return
 
-    # Handle +/- buttons
-    if query.data not in {"plus", "minus"}:
+    if swear_count <= 0:
+        await answer_query(query, "Please add at least 1 swear", show_alert=True)
         return
 
-    delta = 0.05 if query.data == "plus" else -0.05
+    amount_cents = swear_count * SWEAR_CENTS
 
-    conn = get_db_connection()
-    c = conn.cursor()
+    await run_db_write(chat_id, insert_pending, user.id, user.first_name, to_user_id, chat_id, amount_cents)
 
-    # Ensure user exists
-    c.execute("""
-        INSERT INTO balances (telegram_id, chat_id, name, amount)
-        VALUES (%s, %s, %s, 0)
-        ON CONFLICT (telegram_id, chat_id) DO NOTHING
-    """, (user.id, chat_id, user.first_name))
+    clear_proxy_state(context)
 
-    # Update balance (never below 0)
-    c.execute("""
-        UPDATE balances
-        SET amount = GREATEST(amount + %s, 0)
-        WHERE telegram_id = %s AND chat_id = %s
-    """, (delta, user.id, chat_id))
-
-    conn.commit()
-    c.close()
-    conn.close()
-
-    # Update the same message
-    await query.edit_message_text(
-        text=get_scoreboard(chat_id),
-        reply_markup=get_keyboard()
+    await answer_query(query, f"Added {swear_count} swears ({format_cents(amount_cents)}) pending for {to_user_name}", show_alert=True)
+    await show_scoreboard(query, chat_id)
+
+
+# Handle proxy cancel
+@callback_route("proxy_cancel")
+async def on_proxy_cancel(query, context, chat_id):
+    clear_proxy_state(context)
+    await show_scoreboard(query, chat_id)
+
+
+# Handle settle up confirmation
+@callback_route("settle")
+async def on_settle(query, context, chat_id):
+    confirm_keyboard = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("Yes, Settle Up", callback_data="settle_confirm"),
+            InlineKeyboardButton("Cancel", callback_data="settle_cancel")
+        ]
+    ])
+    scoreboard_text, _ = await get_scoreboard(chat_id)
+    edit_query_message(
+        query,
+        f"{scoreboard_text}\n\n{query.from_user.first_name}, reset your balance to $0?",
+        confirm_keyboard
     )
 
+
+@callback_route("settle_confirm")
+async def on_settle_confirm(query, context, chat_id):
+    await run_db_write(chat_id, settle_balance, query.from_user.id, chat_id)
+    await show_scoreboard(query, chat_id)
+
+
+# Handle pending confirmation
+@callback_route(prefix="confirm_pending", answers=True)
+async def on_confirm_pending(query, context, chat_id, transaction_id):
+    user = query.from_user
+    found = await run_db_write(chat_id, confirm_pending, transaction_id, user.id, user.first_name, chat_id)
+    if not found:
+        await answer_query(query, "Transaction not found or already processed", show_alert=True)
+        return
+    await answer_query(query)
+
+    await show_scoreboard(query, chat_id)
+
+
+# Handle reject pending
+@callback_route(prefix="reject_pending")
+async def on_reject_pending(query, context, chat_id, transaction_id):
+    await run_db_write(chat_id, reject_pending, transaction_id, query.from_user.id, chat_id)
+    await show_scoreboard(query, chat_id)
+
+
+# Handle cancel and back to scoreboard
+@callback_route("settle_cancel")
+@callback_route("back_to_scoreboard")
+async def on_back_to_scoreboard(query, context, chat_id):
+    await show_scoreboard(query, chat_id)
+
+
+# Handle +/- buttons
+@callback_route("plus")
+@callback_route("minus")
+async def on_tap(query, context, chat_id):
+    delta = SWEAR_CENTS if query.data == "plus" else -SWEAR_CENTS
+
+    # The batch's first tap schedules the flush; later taps in the window just
+    # join it, and the scoreboard message is edited once with the final state.
+    if queue_tap(query, delta):
+        if TAP_COALESCE_MS > 0:
+            context.application.create_task(flush_taps(chat_id, TAP_COALESCE_MS / 1000))
+        else:
+            await flush_taps(chat_id, 0)
+
+
+@instrument_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages (proxy amount is now button-based)."""
     user = update.effective_user
@@ -521,18 +1858,642 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if context.user_data.get('proxy_to_user_id'):
-        await update.message.reply_text("Use the ➕ / ➖ buttons and tap Confirm in the proxy view.")
+        context.application.create_task(
+            send_reply(update.message, "Use the ➕ / ➖ buttons and tap Confirm in the proxy view."), update=update
+        )
         return
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    handler_errors.inc(type(context.error).__name__)
     logger.exception("Unhandled bot error", exc_info=context.error)
 
+# ======================
+# WEBHOOK DEDUPLICATION
+# ======================
+class UpdateDeduplicator:
+    """Remembers the last `window` update_ids the webhook journaled."""
+
+    def __init__(self, window):
+        self._order = deque()
+        self._seen = set()
+        self._window = window
+        self.duplicates = 0
+
+    def seen(self, update_id):
+        return update_id in self._seen
+
+    def remember(self, update_id):
+        if update_id in self._seen:
+            return
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self._window:
+            self._seen.discard(self._order.popleft())
+
+
+update_dedup = UpdateDeduplicator(DEDUP_WINDOW)
+
+
+async def journal_update(update_id, priority, payload, chat_id):
+    """Journal a webhook update. Returns False if it is a replay and was dropped.
+
+    The id is remembered only once the update is journaled (and, with
+    DEDUP_PERSIST, claimed in Postgres). If journaling raises, nothing is
+    left recorded, so the request fails and Telegram's retry is processed
+    rather than taken for a duplicate. If Postgres can't be reached for the
+    claim, the update is accepted on the local checks alone; taps are
+    buffered offline during an outage anyway.
+    """
+    if update_dedup.seen(update_id):
+        update_dedup.duplicates += 1
+        return False
+    claimed = False
+    if DEDUP_PERSIST:
+        try:
+            if not await run_db(claim_update, update_id):
+                update_dedup.duplicates += 1
+                update_dedup.remember(update_id)
+                return False
+            claimed = True
+        except DatabaseUnavailable as e:
+            logger.warning("Postgres unavailable, deduplicating update %s locally: %s", update_id, e)
+    try:
+        journaled = update_journal.append(update_id, priority, payload, chat_id)
+    except Exception:
+        if claimed:
+            try:
+                await run_db(release_update, update_id)
+            except Exception:
+                logger.exception("Could not release claim on update %s; its retry will be dropped", update_id)
+        raise
+    update_dedup.remember(update_id)
+    if not journaled:
+        # Still journaled from before a restart
+        update_dedup.duplicates += 1
+    return journaled
+
+# ======================
+# UPDATE JOURNAL
+# ======================
+class UpdateJournal:
+    """Crash-safe hand-off between the webhook and PTB.
+
+    The webhook appends the raw update and acknowledges straight away. feed()
+    moves entries onto the update queue, and an entry is deleted only once its
+    update has been fully processed, so anything a restart interrupts is
+    replayed on the next startup. A ➕/➖ tap is only applied when its batch is
+    flushed, after the handler returns, so its entry is kept until then (see
+    defer_ack()).
+
+    The backlog waits here rather than in memory: feed() keeps at most
+    MAX_CONCURRENT_UPDATES updates in flight and at most one per chat, taking
+    button presses before other updates and each priority in arrival order.
+    A burst of presses in one chat holds a single slot, so other chats'
+    updates go straight past it.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Commits survive a process crash; only an OS crash can lose the tail
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+        CREATE TABLE IF NOT EXISTS journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            update_id INTEGER UNIQUE,
+            priority INTEGER NOT NULL,
+            payload BLOB NOT NULL,
+            chat_id INTEGER
+        )
+        """)
+        # Journals left by a version that didn't record the chat
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(journal)")}
+        if "chat_id" not in columns:
+            self._db.execute("ALTER TABLE journal ADD COLUMN chat_id INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS journal_order ON journal (priority, seq)")
+        # Entries appended but not yet processed
+        self.backlog = self._db.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+        # Fed to PTB and still being processed
+        self.in_flight = 0
+        # update_id -> (seq, callback_query_id) of every entry fed and not yet deleted
+        self._fed = {}
+        # update_id -> chat_id of entries being processed
+        self._running = {}
+        # callback_query_id -> update_id, for defer_ack()
+        self._callbacks = {}
+        # Processed updates whose entry waits for ack()
+        self._deferred = set()
+        # Chats with an update in flight; their next entry waits
+        self._busy_chats = set()
+        self._wakeup = asyncio.Event()
+
+    def append(self, update_id, priority, payload, chat_id):
+        """Journal a raw update. Returns False if it is already journaled."""
+        cur = self._db.execute(
+            "INSERT OR IGNORE INTO journal (update_id, priority, payload, chat_id) VALUES (?, ?, ?, ?)",
+            (update_id, priority, payload, chat_id)
+        )
+        if cur.rowcount != 1:
+            return False
+        self.backlog += 1
+        self._wakeup.set()
+        return True
+
+    def finish(self, update_id):
+        """The update's handlers are done: free its slot and chat, and ack it
+        unless defer_ack() was called for it."""
+        if update_id in self._running:
+            self._busy_chats.discard(self._running.pop(update_id))
+            self.in_flight -= 1
+            self._wakeup.set()
+        if update_id not in self._deferred:
+            self.ack(update_id)
+
+    def defer_ack(self, callback_query_id):
+        """Keep a button press journaled past finish(). Returns its update_id
+        for a later ack(), or None if it didn't come through the journal."""
+        update_id = self._callbacks.get(callback_query_id)
+        if update_id is not None:
+            self._deferred.add(update_id)
+        return update_id
+
+    def ack(self, update_id):
+        cur = self._db.execute("DELETE FROM journal WHERE update_id = ?", (update_id,))
+        if cur.rowcount:
+            self.backlog -= 1
+        _, callback_query_id = self._fed.pop(update_id, (None, None))
+        self._callbacks.pop(callback_query_id, None)
+        self._deferred.discard(update_id)
+
+    def _next_entry(self):
+        return self._db.execute("""
+            SELECT seq, update_id, chat_id, payload FROM journal
+            WHERE seq NOT IN (SELECT value FROM json_each(?))
+              AND (chat_id IS NULL OR chat_id NOT IN (SELECT value FROM json_each(?)))
+            ORDER BY priority, seq
+            LIMIT 1
+        """, (
+            json.dumps([seq for seq, _ in self._fed.values()]),
+            json.dumps(list(self._busy_chats))
+        )).fetchone()
+
+    async def feed(self, ptb_app):
+        if self.backlog:
+            logger.info("Replaying %d journaled updates", self.backlog)
+        while True:
+            row = None
+            if self.in_flight < MAX_CONCURRENT_UPDATES:
+                row = self._next_entry()
+            if row is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            seq, update_id, chat_id, payload = row
+            update = Update.de_json(json.loads(payload), ptb_app.bot)
+            callback_query_id = update.callback_query.id if update.callback_query else None
+            self._fed[update_id] = (seq, callback_query_id)
+            if callback_query_id is not None:
+                self._callbacks[callback_query_id] = update_id
+            self._running[update_id] = chat_id
+            if chat_id is not None:
+                self._busy_chats.add(chat_id)
+            self.in_flight += 1
+            await ptb_app.update_queue.put(update)
+
+    def close(self):
+        self._db.close()
+
+
+# Set in webhook mode; polling updates are not journaled
+update_journal = None
+
+# ======================
+# LOAD SHEDDING
+# ======================
+shed_stats = {"text_dropped": 0, "rejected": 0}
+
+
+def is_low_value(data):
+    """Plain chat text: the bot at most replies with a hint."""
+    text = data.get("message", {}).get("text")
+    return text is not None and not text.startswith("/")
+
+
+def update_priority(data):
+    # Button presses jump ahead of commands and text
+    return 0 if "callback_query" in data else 1
+
+# ======================
+# INLINE WEBHOOK REPLIES
+# ======================
+# Telegram accepts one Bot API call in the body of the webhook response. For
+# a button press, the answer goes back inline and the outbound request is
+# skipped: at once if early_answer() knows it, otherwise if the handler
+# answers within INLINE_REPLY_WAIT_MS. Later answers are sent normally.
+
+# callback_query_id -> future the webhook is waiting on
+inline_answers = {}
+inline_stats = {"inlined": 0, "sent": 0}
+
+
+async def wait_for_inline_answer(callback_query_id):
+    """Return the answerCallbackQuery parameters, or None if not answered in time."""
+    waiter = asyncio.get_running_loop().create_future()
+    inline_answers[callback_query_id] = waiter
+    try:
+        return await asyncio.wait_for(waiter, INLINE_REPLY_WAIT_MS / 1000)
+    except asyncio.TimeoutError:
+        inline_stats["sent"] += 1
+        return None
+    finally:
+        inline_answers.pop(callback_query_id, None)
+
+
+def take_inline_answer(request_data):
+    """Hand an answer to a waiting webhook. Returns False if none is waiting."""
+    if request_data is None:
+        return False
+    parameters = request_data.parameters
+    waiter = inline_answers.pop(parameters.get("callback_query_id"), None)
+    if waiter is None or waiter.done():
+        return False
+    waiter.set_result(parameters)
+    inline_stats["inlined"] += 1
+    return True
+
+# ======================
+# OUTBOUND RATE LIMITING
+# ======================
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self):
+        """Seconds until a token is available (0 if one is now)."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        # Empty the bucket far enough that the next token is `seconds` away
+        self.wait_time()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class ApiScheduler(BaseRateLimiter):
+    """Pace Bot API calls under Telegram's flood limits.
+
+    Calls addressed to a chat take a token from the global bucket and from
+    the chat's. Callback answers (and calls without a chat) skip the buckets
+    so a busy group's backlog never delays a button's spinner. Of several
+    edits to one message waiting for a token, only the newest is sent; the
+    others return True as if they had succeeded. A 429 pauses the chat (or
+    everything) for as long as Telegram asks and then retries.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(API_GLOBAL_PER_SECOND, API_GLOBAL_PER_SECOND)
+        # An idle bucket refills within a minute; evicted ones start out full
+        self._chats = TTLCache(maxsize=10000, ttl=60)
+        # (chat_id, message_id) -> ticket of the newest edit waiting for it
+        self._latest_edit = {}
+        self.stats = {"throttled": 0, "superseded": 0, "retry_after": 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(API_PRIVATE_PER_SECOND, API_CHAT_BURST)
+            else:
+                bucket = TokenBucket(API_GROUP_PER_MINUTE / 60, API_CHAT_BURST)
+        # Re-set on every use so the TTL only evicts idle chats
+        self._chats[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if endpoint == "answerCallbackQuery" or chat_id is None:
+            return await self._send(callback, args, kwargs, None)
+
+        if endpoint != "editMessageText" or not data.get("message_id"):
+            return await self._send(callback, args, kwargs, chat_id)
+        edit_key = (chat_id, data["message_id"])
+        ticket = self._latest_edit[edit_key] = object()
+        try:
+            return await self._send(callback, args, kwargs, chat_id, edit_key, ticket)
+        finally:
+            if self._latest_edit.get(edit_key) is ticket:
+                del self._latest_edit[edit_key]
+
+    async def _send(self, callback, args, kwargs, chat_id, edit_key=None, ticket=None):
+        for attempt in range(API_MAX_RETRIES + 1):
+            if chat_id is not None:
+                throttled = False
+                while True:
+                    if ticket and self._latest_edit.get(edit_key) is not ticket:
+                        # A newer edit of this message will carry the final text
+                        self.stats["superseded"] += 1
+                        return True
+                    bucket = self._chat_bucket(chat_id)
+                    wait = max(self._global.wait_time(), bucket.wait_time())
+                    if wait == 0:
+                        self._global.take()
+                        bucket.take()
+                        break
+                    throttled = True
+                    await asyncio.sleep(wait)
+                if throttled:
+                    self.stats["throttled"] += 1
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == API_MAX_RETRIES:
+                    raise
+                self.stats["retry_after"] += 1
+                logger.warning("Telegram asked to retry %s for chat %s in %ss", args[0], chat_id, e.retry_after)
+                if chat_id is None:
+                    self._global.pause(e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                else:
+                    # Waited out in the loop above, where a newer edit can
+                    # still supersede this one
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+
+
+api_scheduler = ApiScheduler()
+
+# ======================
+# UPDATE PROCESSING
+# ======================
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Run updates from different chats concurrently, but one chat's in order.
+
+    Each chat gets a lock while it has updates in flight. Updates are handed
+    over in arrival order and asyncio locks wake waiters FIFO, so taps in a
+    chat apply in the order Telegram sent them and the last scoreboard edit
+    reflects the final state.
+
+    PTB takes its own semaphore before do_process_update(), while an update
+    may still be queued behind its chat, so that one is left unbounded and
+    the max_concurrent_updates slots are handed out here once the chat is
+    free. A burst in one chat then waits without holding slots other chats
+    need. A button press whose answer doesn't depend on its handler is
+    answered before it waits (see start_early_answer()).
+    """
+
+    def __init__(self, max_concurrent_updates):
+        self._slot_count = max_concurrent_updates
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}
+        # chat_id -> updates waiting for or holding the chat's lock
+        self.in_flight = {}
+        # Updates holding a slot
+        self.running = 0
+
+    @property
+    def max_concurrent_updates(self):
+        return self._slot_count
+
+    async def do_process_update(self, update, coroutine):
+        if isinstance(update, Update) and update.callback_query:
+            start_early_answer(update.callback_query)
+        try:
+            await self._process_in_chat_order(update, coroutine)
+        finally:
+            if update_journal is not None and isinstance(update, Update):
+                update_journal.finish(update.update_id)
+
+    async def _process_in_chat_order(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await self._run(coroutine)
+            return
+
+        chat_id = chat.id
+        self.in_flight[chat_id] = self.in_flight.get(chat_id, 0) + 1
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with lock:
+                await self._run(coroutine)
+        finally:
+            remaining = self.in_flight[chat_id] - 1
+            if remaining:
+                self.in_flight[chat_id] = remaining
+            else:
+                # Nothing else references the lock; keep the dicts bounded
+                del self.in_flight[chat_id]
+                del self._chat_locks[chat_id]
+
+    async def _run(self, coroutine):
+        async with self._slots:
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+update_processor = PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES)
+
+
+def ping_db(c):
+    c.execute("SELECT 1")
+
+
+# (checked_at, ready, details); probes within READY_CACHE_SECONDS reuse it
+readiness = (None, False, {})
+readiness_lock = asyncio.Lock()
+
+
+async def check_readiness(ptb_app):
+    global readiness
+    async with readiness_lock:
+        checked_at, ready, details = readiness
+        now = time.monotonic()
+        if checked_at is not None and now - checked_at < READY_CACHE_SECONDS:
+            return ready, details
+
+        details = {}
+        try:
+            await asyncio.wait_for(run_db(ping_db), READY_DB_TIMEOUT)
+            details["db"] = "ok"
+        except Exception as e:
+            details["db"] = f"failed: {type(e).__name__}"
+
+        backlog = update_journal.backlog if update_journal else ptb_app.update_queue.qsize()
+        details["backlog"] = backlog
+
+        # A quiet bot makes no API calls, so only probe when the last success is stale
+        if api_last_success is None or now - api_last_success > READY_MAX_API_AGE:
+            try:
+                await ptb_app.bot.get_me()
+            except Exception:
+                pass
+        api_age = None if api_last_success is None else time.monotonic() - api_last_success
+        details["api_age_s"] = None if api_age is None else round(api_age, 1)
+
+        ready = (
+            details["db"] == "ok"
+            and backlog < READY_MAX_BACKLOG
+            and api_age is not None and api_age <= READY_MAX_API_AGE
+        )
+        readiness = (time.monotonic(), ready, details)
+        return ready, details
+
+
+def render_metrics(ptb_app):
+    lines = []
+    for metric in (
+        handler_seconds, callback_seconds, callback_rejected,
+        db_seconds, db_retries, api_seconds, api_errors, handler_errors
+    ):
+        lines.extend(metric.render())
+
+    pool = pool_metrics()
+    counters = {
+        "swearjar_db_checkouts_total": pool["checkouts"],
+        "swearjar_db_errors_total": pool["errors"],
+        "swearjar_scoreboard_cache_hits_total": scoreboard_cache_stats["hits"],
+        "swearjar_scoreboard_cache_misses_total": scoreboard_cache_stats["misses"],
+        "swearjar_scoreboard_cache_invalidations_total": scoreboard_cache_stats["invalidations"],
+        "swearjar_duplicate_updates_total": update_dedup.duplicates,
+        "swearjar_shed_text_total": shed_stats["text_dropped"],
+        "swearjar_rejected_updates_total": shed_stats["rejected"],
+        "swearjar_proxy_flows_expired_total": sweep_stats["flows_expired"],
+        "swearjar_user_data_dropped_total": sweep_stats["user_data_dropped"],
+        "swearjar_balance_deltas_merged_total": compaction_stats["rows_merged"],
+        "swearjar_offline_writes_buffered_total": offline_writes.buffered if offline_writes else 0,
+        "swearjar_offline_writes_replayed_total": offline_writes.replayed if offline_writes else 0,
+        "swearjar_inline_answers_total": inline_stats["inlined"],
+        "swearjar_inline_answers_missed_total": inline_stats["sent"],
+        "swearjar_api_throttled_total": api_scheduler.stats["throttled"],
+        "swearjar_edits_sent_total": edit_stats["sent"],
+        "swearjar_edits_skipped_total": edit_stats["skipped"],
+        "swearjar_edits_replaced_total": edit_stats["replaced"],
+        "swearjar_edits_failed_total": edit_stats["failed"],
+        "swearjar_api_edits_superseded_total": api_scheduler.stats["superseded"],
+        "swearjar_api_retry_after_total": api_scheduler.stats["retry_after"],
+    }
+    gauges = {
+        "swearjar_db_connections_in_use": pool["in_use"],
+        "swearjar_db_connections_idle": pool["idle"],
+        "swearjar_db_connections_open": pool["open"],
+        "swearjar_update_queue_depth": ptb_app.update_queue.qsize(),
+        "swearjar_update_backlog": update_journal.backlog if update_journal else 0,
+        "swearjar_updates_in_flight": sum(update_processor.in_flight.values()),
+        "swearjar_updates_running": update_processor.running,
+        "swearjar_chats_in_flight": len(update_processor.in_flight),
+        "swearjar_tap_batches_pending": len(pending_taps),
+        # Messages with an edit waiting or being sent
+        "swearjar_edits_queued": len(edit_senders),
+        "swearjar_offline_writes_pending": offline_writes.pending if offline_writes else 0,
+        "swearjar_offline_writes_dead": offline_writes.dead if offline_writes else 0,
+        "swearjar_proxy_flows_active": len(proxy_flows),
+        "swearjar_user_data_entries": len(ptb_app.user_data),
+    }
+    for kind, values in (("counter", counters), ("gauge", gauges)):
+        for name, value in values.items():
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def build_request(pool_size):
+    return InstrumentedRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=API_CONNECT_TIMEOUT,
+        read_timeout=API_READ_TIMEOUT,
+        write_timeout=API_WRITE_TIMEOUT,
+        pool_timeout=API_POOL_TIMEOUT,
+        http_version="2" if API_HTTP2 else "1.1",
+        # httpx drops idle connections after 5s by default; keep them warm
+        # across the gaps between bursts of taps
+        httpx_kwargs={"limits": httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=API_KEEPALIVE_SECONDS
+        )}
+    )
+
+
+def build_application(builder):
+    ptb_app = (
+        builder
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        .request(build_request(API_POOL_SIZE))
+        .get_updates_request(build_request(1))
+        .rate_limiter(api_scheduler)
+        .concurrent_updates(update_processor)
+        .update_queue(asyncio.Queue(UPDATE_QUEUE_MAX))
+        .persistence(ConversationStatePersistence())
+        .build()
+    )
+
+    ptb_app.add_handler(CommandHandler("start", start))
+    ptb_app.add_handler(CallbackQueryHandler(handle_button))
+    ptb_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    ptb_app.add_error_handler(error_handler)
+    return ptb_app
+
 # ======================
 # MAIN
 # ======================
+# Render stops an instance with SIGTERM; Ctrl+C sends SIGINT
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
 async def run():
-    init_db()
+    global offline_writes
+
+    # Without handlers SIGTERM ends the process on the spot, skipping the
+    # finally blocks that stop PTB (flushing conversation state) and close
+    # the journal and offline buffer
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in STOP_SIGNALS:
+        loop.add_signal_handler(sig, stop.set)
+
+    # Startup DB work runs off the loop too, like everything in handlers
+    await asyncio.to_thread(init_pool)
+    try:
+        await loop.run_in_executor(db_executor, init_db)
+        offline_writes = OfflineWriteBuffer(OFFLINE_BUFFER_PATH)
+        # Left over from an outage that outlasted the last run
+        offline_writes.start_replay()
+        await serve(stop)
+    finally:
+        if offline_writes is not None:
+            offline_writes.close()
+        await asyncio.to_thread(close_pool)
+        for sig in STOP_SIGNALS:
+            loop.remove_signal_handler(sig)
+
+
+async def serve(stop):
+    """Run the bot until stop is set."""
+    global update_journal
 
     render_hostname = os.getenv("RENDER_EXTERNAL_HOSTNAME")
     webhook_base = os.getenv("WEBHOOK_URL") or (
@@ -543,17 +2504,7 @@ async def run():
         # --- Webhook mode (Render) ---
         # Build without PTB's built-in updater so we control the aiohttp server
         # ourselves. This lets us add a health-check route for uptime bots.
-        ptb_app = (
-            ApplicationBuilder()
-            .token(BOT_TOKEN)
-            .updater(None)
-            .build()
-        )
-
-        ptb_app.add_handler(CommandHandler("start", start))
-        ptb_app.add_handler(CallbackQueryHandler(handle_button))
-        ptb_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        ptb_app.add_error_handler(error_handler)
+        ptb_app = build_application(ApplicationBuilder().updater(None))
 
         PORT = int(os.getenv("PORT", 10000))
         webhook_url = f"{webhook_base.rstrip('/')}/{BOT_TOKEN}"
@@ -562,21 +2513,74 @@ async def run():
         async def health(request):
             return web.Response(text="OK")
 
-        # Telegram webhook handler — Telegram sends POST /{token}
+        update_journal = UpdateJournal(JOURNAL_PATH)
+
+        # Readiness — unlike /health, fails when this instance can't serve taps
+        async def ready(request):
+            is_ready, details = await check_readiness(ptb_app)
+            return web.json_response(details, status=200 if is_ready else 503)
+
+        async def metrics(request):
+            return web.Response(
+                text=render_metrics(ptb_app),
+                headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+            )
+
+        # Telegram webhook handler — Telegram sends POST /{token}. The update
+        # is journaled and acknowledged; journal.feed() hands it to PTB.
         async def telegram_webhook(request):
-            from telegram import Update as TGUpdate
-            data = await request.json()
-            update = TGUpdate.de_json(data, ptb_app.bot)
-            await ptb_app.update_queue.put(update)
+            payload = await request.read()
+            data = json.loads(payload)
+            update_id = data.get("update_id")
+
+            # Shed before dedup so a rejected update isn't remembered as seen
+            if update_journal.backlog >= SHED_TEXT_AT and is_low_value(data):
+                shed_stats["text_dropped"] += 1
+                return web.Response(text="OK")
+            if update_journal.backlog >= UPDATE_QUEUE_MAX:
+                shed_stats["rejected"] += 1
+                return web.Response(
+                    status=503,
+                    headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+                    text="Busy"
+                )
+
+            # Telegram re-POSTs updates we were slow to acknowledge; applying
+            # them again would double a ➕ or a confirmation
+            chat = Update.de_json(data, ptb_app.bot).effective_chat
+            journaled = await journal_update(
+                update_id, update_priority(data), payload, chat.id if chat else None
+            )
+            if not journaled:
+                logger.info("Dropped duplicate update %s", update_id)
+            elif INLINE_REPLY_WAIT_MS > 0 and "callback_query" in data:
+                query = data["callback_query"]
+                answer = early_answer(query.get("data"), query["from"]["id"])
+                if answer is None:
+                    answer = await wait_for_inline_answer(query["id"])
+                elif claim_answer(query["id"]):
+                    # Known without running the handler, so it needn't
+                    # wait for the chat's earlier updates
+                    inline_stats["inlined"] += 1
+                    answer = {"callback_query_id": query["id"], **answer}
+                else:
+                    answer = None
+                if answer is not None:
+                    return web.json_response({"method": "answerCallbackQuery", **answer})
             return web.Response(text="OK")
 
         aiohttp_app = web.Application()
         aiohttp_app.router.add_get("/", health)
         aiohttp_app.router.add_get("/health", health)
+        aiohttp_app.router.add_get("/ready", ready)
+        aiohttp_app.router.add_get("/metrics", metrics)
         aiohttp_app.router.add_post(f"/{BOT_TOKEN}", telegram_webhook)
 
         async with ptb_app:
             await ptb_app.start()
+            feeder = asyncio.create_task(update_journal.feed(ptb_app))
+            sweeper = asyncio.create_task(sweep_user_data(ptb_app))
+            compactor = asyncio.create_task(compact_balances_periodically())
             await ptb_app.bot.set_webhook(url=webhook_url)
             logger.info("Webhook set to %s", webhook_url)
 
@@ -586,28 +2590,58 @@ async def run():
             await site.start()
             logger.info("Swear Jar Bot running on port %d (webhook + health check)", PORT)
 
-            # Run until interrupted
-            await asyncio.Event().wait()
-
-            await runner.cleanup()
-            await ptb_app.stop()
+            # Run until SIGTERM/SIGINT
+            try:
+                await stop.wait()
+            finally:
+                await runner.cleanup()
+                feeder.cancel()
+                sweeper.cancel()
+                compactor.cancel()
+                await ptb_app.stop()
+                update_journal.close()
 
     else:
         # --- Polling mode (local dev) ---
-        ptb_app = ApplicationBuilder().token(BOT_TOKEN).build()
+        ptb_app = build_application(ApplicationBuilder())
 
-        ptb_app.add_handler(CommandHandler("start", start))
-        ptb_app.add_handler(CallbackQueryHandler(handle_button))
-        ptb_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        ptb_app.add_error_handler(error_handler)
-
-        logger.info("Starting polling mode")
-        print("Swear Jar Bot is running (polling)...")
-        ptb_app.run_polling()
+        # run_polling() would start its own event loop; drive the updater
+        # manually so handlers share this loop (and the DB pool) instead.
+        async with ptb_app:
+            await ptb_app.start()
+            await ptb_app.updater.start_polling()
+            sweeper = asyncio.create_task(sweep_user_data(ptb_app))
+            compactor = asyncio.create_task(compact_balances_periodically())
+            logger.info("Starting polling mode")
+            print("Swear Jar Bot is running (polling)...")
+
+            try:
+                await stop.wait()
+            finally:
+                sweeper.cancel()
+                compactor.cancel()
+                await ptb_app.updater.stop()
+                await ptb_app.stop()
+
+
+def rebuild():
+    """`python swear_jar_bot.py rebuild-balances`: resync balances with the ledger."""
+    init_pool()
+    try:
+        init_db()
+        with db_cursor() as c:
+            corrected = rebuild_balances(c)
+        logger.info("Rebuilt balances from ledger (%d corrected)", corrected)
+    finally:
+        close_pool()
 
 
 def main():
-    asyncio.run(run())
+    if sys.argv[1:] == ["rebuild-balances"]:
+        rebuild()
+    else:
+        asyncio.run(run())
+        logger.info("Stopped")
 
 
 if __name__ == "__main__":
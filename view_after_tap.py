@@ -0,0 +1,130 @@
+"""A button pressed during a tap's coalescing window keeps the view it opened.
+
+Starts the bot in webhook mode (see loadtest.py), and in fresh chats sends a
+➕ tap followed, --gap-ms later, by a press that opens another view on the
+same scoreboard message: Settle Up!, Proxy Add, or a proxy_select by another
+member. Once the bot is idle, the last edit of the message must be that
+view, showing the total with the tap applied, and not the scoreboard the
+tap's delayed flush renders.
+
+    python view_after_tap.py --database-url postgresql://localhost/swearjar_load
+"""
+import sys
+import asyncio
+import argparse
+import tempfile
+from aiohttp import ClientSession
+from loadtest import (
+    SCOREBOARD_MESSAGE_ID, FakeBotApi, LoadRun, callback_update, load_bot, number_updates,
+    scratch_chat_id, wait_until
+)
+
+TAPPER, OTHER = 1, 2
+
+# name -> (updates after the tap as (user_id, callback_data), text the final view starts with)
+SCENARIOS = {
+    "settle": ([(TAPPER, "settle")], "Swear Jar"),
+    "proxy_start": ([(OTHER, "proxy_start")], "Select who to add swears for:"),
+    "proxy_select": ([(OTHER, "proxy_start"), (OTHER, f"proxy_select_{TAPPER}")], "How many swears to add"),
+}
+
+
+def last_edit(fake_api, chat_id):
+    for method, params in reversed(fake_api.calls):
+        if (method == "editMessageText" and int(params["chat_id"]) == chat_id
+                and int(params["message_id"]) == SCOREBOARD_MESSAGE_ID):
+            return params
+    return None
+
+
+async def run_scenarios(args):
+    fake_api = FakeBotApi(0)
+    await fake_api.start(args.api_port)
+    failures = []
+    with tempfile.TemporaryDirectory(prefix="swearjar-view-") as workdir:
+        bot = load_bot(args, workdir)
+        bot_task = asyncio.create_task(bot.run())
+        try:
+            async with ClientSession() as session:
+                load = LoadRun(args, bot, fake_api)
+
+                async def healthy():
+                    try:
+                        async with session.get(f"{load.base_url}/health") as response:
+                            return response.status == 200
+                    except OSError:
+                        return False
+                if not await wait_until(healthy, 30):
+                    raise RuntimeError("bot did not come up; see its log output")
+
+                next_id = 1
+                for name, (presses, expected) in SCENARIOS.items():
+                    chat_id = scratch_chat_id()
+                    # Both members get a balance row, so Proxy Add has someone to pick
+                    setup = [callback_update(chat_id, OTHER, "plus")]
+                    if name == "proxy_select":
+                        setup += [callback_update(chat_id, OTHER, "proxy_start")]
+                        presses = presses[1:]
+                    setup = number_updates(setup, next_id)
+                    tap, *rest = updates = number_updates(
+                        [callback_update(chat_id, TAPPER, "plus")]
+                        + [callback_update(chat_id, user_id, data) for user_id, data in presses],
+                        next_id + len(setup)
+                    )
+                    next_id += len(setup) + len(updates)
+
+                    for update in setup:
+                        await load.post(session, update)
+                    await load.drain(session, args.drain_timeout)
+                    await load.post(session, tap)
+                    for update in rest:
+                        await asyncio.sleep(args.gap_ms / 1000)
+                        await load.post(session, update)
+                    await load.drain(session, args.drain_timeout)
+
+                    edit = last_edit(fake_api, chat_id)
+                    text = edit["text"] if edit else ""
+                    shown = text.splitlines()[0] if text else "no edit"
+                    print(f"{name:12} last edit: {shown!r}")
+                    if not text.startswith(expected):
+                        failures.append(f"{name}: the message ended on {shown!r}, not {expected!r}")
+                    elif name == "settle" and "reset your balance" not in text:
+                        failures.append("settle: the Yes/Cancel prompt was replaced by the scoreboard")
+                    elif name == "settle" and f"User{TAPPER}: {bot.format_cents(bot.SWEAR_CENTS)}" not in text:
+                        failures.append("settle: the prompt shows the total from before the tap")
+        finally:
+            bot_task.cancel()
+            try:
+                await bot_task
+            except asyncio.CancelledError:
+                pass
+            await fake_api.stop()
+    return failures
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database-url", required=True, help="scratch Postgres the bot may migrate")
+    parser.add_argument("--gap-ms", type=float, default=50, help="delay between the tap and the next press")
+    parser.add_argument("--port", type=int, default=18443)
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--drain-timeout", type=float, default=30)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    args = parser.parse_args(argv)
+    # load_bot() and LoadRun options this script doesn't expose
+    args.telegram_limits = False
+    args.connections = 1
+    args.settle_seconds = 0.2
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    failures = asyncio.run(run_scenarios(args))
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())